@@ -0,0 +1,274 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+import requests
+
+import http_client
+import metrics
+
+
+def load_settings():
+    """Read the download limits and cache settings from the environment and build the cache
+    and download slots from them, on import and again from create_app()"""
+    global MAX_BYTES, TIMEOUT, MAX_DOWNLOADS, CACHE_DIR, CACHE_MAX_BYTES, CACHE_TTL, cache, _slots
+    # Largest artwork accepted, Spotify covers are a few hundred KB at most
+    MAX_BYTES = int(os.getenv('ARTWORK_MAX_BYTES', str(5 * 1024 * 1024)))
+    # Seconds a whole download may take, from waiting for a slot to the last byte
+    TIMEOUT = float(os.getenv('ARTWORK_TIMEOUT', '10'))
+    # Downloads running at once, so at most MAX_DOWNLOADS * MAX_BYTES of artwork is in memory
+    MAX_DOWNLOADS = int(os.getenv('ARTWORK_MAX_DOWNLOADS', '32'))
+    # Directory of the on-disk artwork cache, empty disables it
+    CACHE_DIR = os.getenv('ARTWORK_CACHE_DIR', 'artwork-cache')
+    CACHE_MAX_BYTES = int(os.getenv('ARTWORK_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+    # Seconds cached artwork is used before it is revalidated with its ETag or Last-Modified
+    CACHE_TTL = int(os.getenv('ARTWORK_CACHE_TTL', str(24 * 60 * 60)))
+
+    cache = ArtworkCache(CACHE_DIR) if CACHE_DIR else None
+    _slots = threading.BoundedSemaphore(MAX_DOWNLOADS)
+
+
+CHUNK_SIZE = 64 * 1024
+# Some CDNs label images generically, anything else is rejected before the body is read
+ACCEPTED_TYPES = ('image/', 'application/octet-stream', 'binary/octet-stream')
+
+
+class ArtworkError(Exception):
+    """The artwork could not be downloaded within the limits"""
+
+
+def check_response(status_code, headers, max_bytes=None):
+    """Rejects a response from its status and headers, returns the announced length or None"""
+    if max_bytes is None:
+        max_bytes = MAX_BYTES
+    if status_code != 200:
+        raise ArtworkError(f"artwork download failed with {status_code}")
+
+    content_type = headers.get('Content-Type', '').split(';')[0].strip().lower()
+    if content_type and not content_type.startswith(ACCEPTED_TYPES):
+        raise ArtworkError(f"artwork is {content_type}, not an image")
+
+    length = headers.get('Content-Length', '')
+    length = int(length) if length.isdigit() else None
+    if length is not None and length > max_bytes:
+        raise ArtworkError(f"artwork is {length} bytes, the limit is {max_bytes}")
+    return length
+
+
+class Buffer:
+    """Collects a response body of at most max_bytes.
+
+    The buffer is allocated once at the announced Content-Length; without
+    one it starts small and doubles, never past max_bytes.
+    """
+
+    def __init__(self, length=None, max_bytes=None):
+        self.max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+        self.data = bytearray(length if length is not None else min(4 * CHUNK_SIZE, self.max_bytes))
+        self.size = 0
+
+    def write(self, chunk):
+        end = self.size + len(chunk)
+        if end > self.max_bytes:
+            raise ArtworkError(f"artwork is over the {self.max_bytes} byte limit")
+        if end > len(self.data):
+            self.data.extend(bytes(min(max(end, 2 * len(self.data)), self.max_bytes) - len(self.data)))
+        self.data[self.size:end] = chunk
+        self.size = end
+
+    def getvalue(self):
+        # trims in place, the body is not copied again
+        del self.data[self.size:]
+        return self.data
+
+
+class ArtworkCache:
+    """Downloaded artwork on disk, one file per URL, revalidated once `ttl` runs out.
+
+    A file holds a JSON line with the URL and its ETag and Last-Modified,
+    then the image bytes. Files are written to a temporary name and renamed,
+    so readers in any process never see half a file. The file's mtime is when
+    it was last validated; once the directory passes max_bytes, the files
+    validated longest ago are removed. Errors are printed and treated as a
+    miss, a download never fails because of the cache.
+    """
+
+    def __init__(self, directory, max_bytes=None, ttl=None):
+        self.directory = directory
+        self.max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.ttl = CACHE_TTL if ttl is None else ttl
+        self._lock = threading.Lock()
+        self._written = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.not_modified = 0
+
+    def _path(self, url):
+        return os.path.join(self.directory, hashlib.sha256(url.encode()).hexdigest())
+
+    def get(self, url):
+        """Returns {'data', 'etag', 'last_modified', 'fresh'} or None"""
+        path = self._path(url)
+        try:
+            with open(path, 'rb') as file:
+                meta = json.loads(file.readline())
+                data = file.read()
+                validated = os.fstat(file.fileno()).st_mtime
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Error reading artwork cache: {e}")
+            self.misses += 1
+            return None
+        if meta.get('url') != url:
+            self.misses += 1
+            return None
+
+        fresh = time.time() - validated < self.ttl
+        if fresh:
+            self.hits += 1
+        else:
+            self.revalidations += 1
+        return dict(meta, data=data, fresh=fresh)
+
+    def set(self, url, data, headers):
+        meta = {
+            'url': url,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+        }
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            descriptor, temporary = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+            try:
+                with os.fdopen(descriptor, 'wb') as file:
+                    file.write(json.dumps(meta).encode() + b'\n')
+                    file.write(data)
+                os.replace(temporary, self._path(url))
+            except BaseException:
+                os.unlink(temporary)
+                raise
+        except OSError as e:
+            print(f"Error writing artwork cache: {e}")
+            return
+
+        with self._lock:
+            self._written += len(data)
+            prune = self._written >= self.max_bytes // 10
+            if prune:
+                self._written = 0
+        if prune:
+            self.prune()
+
+    def revalidated(self, url):
+        """Marks cached artwork as fresh again after a 304"""
+        self.not_modified += 1
+        try:
+            os.utime(self._path(url))
+        except OSError as e:
+            print(f"Error updating artwork cache: {e}")
+
+    def prune(self):
+        """Removes the files validated longest ago until the cache fits in max_bytes"""
+        try:
+            files = []
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if entry.is_file() and not entry.name.startswith('.tmp-'):
+                        stat = entry.stat()
+                        files.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                os.unlink(path)
+                total -= size
+        except OSError as e:
+            print(f"Error pruning artwork cache: {e}")
+
+
+def conditional_headers(cached):
+    """If-None-Match and If-Modified-Since for revalidating a cache entry"""
+    headers = {}
+    if cached is not None:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+    return headers
+
+
+load_settings()
+
+
+def _get(url, cached, deadline, timeout):
+    """GETs url with the retry rules of http_client, but never past the deadline"""
+    for attempt in range(http_client.MAX_RETRIES + 1):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            response = http_client.get(url, retry=False, headers=conditional_headers(cached), stream=True,
+                                       timeout=(min(http_client.CONNECT_TIMEOUT, remaining),
+                                                min(http_client.READ_TIMEOUT, remaining)))
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == http_client.MAX_RETRIES:
+                raise ArtworkError(f"artwork download failed: {e}")
+            delay = http_client.BACKOFF_FACTOR * (2 ** attempt)
+        else:
+            if response.status_code not in http_client.RETRY_STATUSES or attempt == http_client.MAX_RETRIES:
+                return response
+            response.close()
+            delay = http_client.retry_delay(response, attempt)
+
+        if time.monotonic() + delay >= deadline:
+            break
+        time.sleep(delay)
+    raise ArtworkError(f"artwork download took longer than {timeout}s")
+
+
+def download(url, max_bytes=None, timeout=None):
+    """The artwork at url, from the cache while fresh, raises ArtworkError.
+
+    The body is streamed into a Buffer and the download is abandoned as soon
+    as it goes over max_bytes. Waiting for a slot, retries and the body all
+    count towards `timeout` seconds.
+    """
+    max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+    timeout = TIMEOUT if timeout is None else timeout
+    cached = cache.get(url) if cache is not None else None
+    if cached is not None and cached['fresh']:
+        return cached['data']
+
+    # released to the same semaphore even if load_settings() replaces it meanwhile
+    slots = _slots
+    deadline = time.monotonic() + timeout
+    if not slots.acquire(timeout=timeout):
+        raise ArtworkError("too many artwork downloads in flight")
+    try:
+        with metrics.span('artwork_download'), _get(url, cached, deadline, timeout) as response:
+            if response.status_code == 304 and cached is not None:
+                cache.revalidated(url)
+                return cached['data']
+
+            buffer = Buffer(check_response(response.status_code, response.headers, max_bytes), max_bytes)
+            for chunk in response.iter_content(CHUNK_SIZE):
+                buffer.write(chunk)
+                if time.monotonic() > deadline:
+                    raise ArtworkError(f"artwork download took longer than {timeout}s")
+    except requests.RequestException as e:
+        # a read timeout or reset while streaming the body
+        raise ArtworkError(f"artwork download failed: {e}")
+    finally:
+        slots.release()
+
+    data = buffer.getvalue()
+    if cache is not None:
+        cache.set(url, data, response.headers)
+    return data
@@ -0,0 +1,601 @@
+"""ASGI version of the palette routes for serving many slow requests at once.
+
+/search, /limited-search and /current-track answer exactly like the Flask
+views, ?stream= included, but Spotify and artwork calls go through one
+asyncio HTTP client, so a request waiting on Spotify costs a coroutine
+instead of a thread. It runs next to the Flask app and shares its palette
+caches, store, worker pool and login session cookie (set the same
+FLASK_SECRET_KEY for both):
+
+    python spotify_color_extractor.py            # Flask, port 5000
+    uvicorn async_app:app --port 5001            # asyncio, port 5001
+
+Needs httpx and an ASGI server such as uvicorn.
+"""
+import asyncio
+import json
+import math
+import time
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+
+import httpx
+from itsdangerous import BadSignature
+
+import artwork
+import http_client
+import metrics
+from http_client import RateLimited
+import palette_engines
+from palette_engines import ENGINES
+from palette_pool import PaletteQueueFull, record_stages
+from singleflight import AsyncSingleFlight
+from spotify_auth import TokenError
+from spotify_cache import AlbumCache, normalize_query
+import color_spaces
+import spotify_color_extractor as extractor
+from spotify_color_extractor import (DEFAULT_SWATCHES, PALETTE_FIELDS, STREAM_FORMATS, album_summary,
+                                     create_app, has_album_fields, palette_payload, remember_colors,
+                                     stored_colors, stream_event, track_summary)
+
+# Reads the settings the Flask side uses and builds its shared state; the app
+# itself is only needed to read its session cookies
+flask_app = create_app()
+
+_client = None
+_artwork_slots = None
+
+# The event loop's counterparts of search_flights and palette_flights
+search_flights = AsyncSingleFlight()
+palette_flights = AsyncSingleFlight()
+
+
+def client():
+    """The shared AsyncClient, created on first use inside the running loop"""
+    global _client
+    if _client is None:
+        # with a transport of its own the client ignores limits=, so they go to the transport
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(http_client.READ_TIMEOUT, connect=http_client.CONNECT_TIMEOUT),
+            transport=httpx.AsyncHTTPTransport(
+                retries=http_client.MAX_RETRIES,
+                limits=httpx.Limits(max_connections=http_client.POOL_SIZE * http_client.POOL_HOSTS,
+                                    max_keepalive_connections=http_client.POOL_SIZE),
+            ),
+        )
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def count_upstream(url, status):
+    """http_client's count of upstream responses, for calls made with the AsyncClient"""
+    metrics.UPSTREAM.inc(httpx.URL(url).host, str(status))
+
+
+async def fetch(url, headers=None, params=None):
+    """GET with the same retry rules as http_client: 429 and 5xx, honoring Retry-After.
+
+    Spotify calls wait for their turn in the same Governor as the Flask
+    side's, so a 429 here holds back every other call of this process too.
+    """
+    governor = http_client.governor_for(url)
+    for attempt in range(http_client.MAX_RETRIES + 1):
+        if governor is not None:
+            await governor.acquire_async()
+        started = time.monotonic()
+        status = None
+        try:
+            response = await client().get(url, headers=headers, params=params)
+            status = response.status_code
+        except httpx.HTTPError:
+            count_upstream(url, 'error')
+            raise
+        finally:
+            if governor is not None:
+                governor.release(started, status,
+                                 http_client.retry_delay(response, attempt) if status == 429 else None)
+        count_upstream(url, status)
+        if status not in http_client.RETRY_STATUSES or attempt == http_client.MAX_RETRIES:
+            return response
+        # the governor already holds the next attempt back until Retry-After
+        if governor is None or status != 429:
+            await asyncio.sleep(http_client.retry_delay(response, attempt))
+    return response
+
+
+class Request:
+    """The few parts of an ASGI request the handlers need"""
+
+    def __init__(self, scope):
+        query = parse_qs(scope.get('query_string', b'').decode(), keep_blank_values=True)
+        self.args = {name: values[0] for name, values in query.items()}
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+                        for name, value in scope.get('headers', [])}
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = load_session(self.headers.get('cookie', ''))
+        return self._session
+
+
+class EventStream:
+    """A response body sent event by event as an async iterator of strings yields them"""
+
+    __slots__ = ('events', 'content_type')
+
+    def __init__(self, events, content_type):
+        self.events = events
+        self.content_type = content_type
+
+
+def load_session(cookie_header):
+    """Read the Flask session cookie, an empty dict if missing or tampered with"""
+    cookies = SimpleCookie()
+    cookies.load(cookie_header)
+    name = flask_app.config['SESSION_COOKIE_NAME']
+    if name not in cookies:
+        return {}
+
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    try:
+        return serializer.loads(cookies[name].value,
+                                max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return {}
+
+
+def requested_engine(request):
+    engine = request.args.get('engine', palette_engines.DEFAULT_ENGINE)
+    if engine not in ENGINES:
+        return None
+    return engine
+
+
+def requested_fields(request):
+    fields = [field.strip() for field in request.args.get('fields', '').split(',') if field.strip()]
+    if any(field not in PALETTE_FIELDS for field in fields):
+        return None
+    return fields
+
+
+def requested_stream(request):
+    """(stream, limit) from ?stream= and ?limit=, limit is None if either is invalid"""
+    stream = request.args.get('stream')
+    if stream is None:
+        return None, 1
+    if stream not in STREAM_FORMATS:
+        return stream, None
+
+    try:
+        limit = int(request.args.get('limit', 5))
+    except ValueError:
+        return stream, None
+    if limit < 1 or limit > extractor.MAX_STREAM_RESULTS:
+        return stream, None
+    return stream, limit
+
+
+def invalid_stream():
+    return 400, {"error": f"stream must be one of {', '.join(STREAM_FORMATS)} and limit between 1 and {extractor.MAX_STREAM_RESULTS}"}
+
+
+async def extract_swatches(image_url, color_count=5, quality=10, engine=None):
+    if engine is None:
+        engine = palette_engines.DEFAULT_ENGINE
+    key = (image_url, color_count, quality, engine)
+    cached = extractor.palette_cache.get(key)
+    if cached is not None:
+        return list(cached)
+    # the palette store is SQLite by default, keep its reads off the event loop
+    known = await asyncio.to_thread(stored_colors, key)
+    if known is not None:
+        return known
+
+    swatches = await palette_flights.do(key, download_colors, key, image_url, color_count, quality, engine)
+    return list(swatches)
+
+
+def artwork_slots():
+    """The event loop's counterpart of artwork's download slots, created inside the running loop"""
+    global _artwork_slots
+    if _artwork_slots is None:
+        _artwork_slots = asyncio.Semaphore(artwork.MAX_DOWNLOADS)
+    return _artwork_slots
+
+
+async def download_artwork(image_url):
+    """artwork.download on the event loop: same limits, same disk cache and revalidation"""
+    cached = None
+    if artwork.cache is not None:
+        cached = await asyncio.to_thread(artwork.cache.get, image_url)
+    if cached is not None and cached['fresh']:
+        return cached['data']
+
+    try:
+        with metrics.span('artwork_download'):
+            return await asyncio.wait_for(stream_artwork(image_url, cached), artwork.TIMEOUT)
+    except httpx.HTTPError:
+        count_upstream(image_url, 'error')
+        raise
+    except asyncio.TimeoutError:
+        raise artwork.ArtworkError(f"artwork download took longer than {artwork.TIMEOUT}s")
+
+
+async def stream_artwork(image_url, cached):
+    async with artwork_slots():
+        for attempt in range(http_client.MAX_RETRIES + 1):
+            async with client().stream('GET', image_url, headers=artwork.conditional_headers(cached)) as response:
+                count_upstream(image_url, response.status_code)
+                if response.status_code not in http_client.RETRY_STATUSES or attempt == http_client.MAX_RETRIES:
+                    if response.status_code == 304 and cached is not None:
+                        await asyncio.to_thread(artwork.cache.revalidated, image_url)
+                        return cached['data']
+
+                    buffer = artwork.Buffer(artwork.check_response(response.status_code, response.headers))
+                    async for chunk in response.aiter_bytes(artwork.CHUNK_SIZE):
+                        buffer.write(chunk)
+                    break
+            await asyncio.sleep(http_client.retry_delay(response, attempt))
+
+    data = buffer.getvalue()
+    if artwork.cache is not None:
+        await asyncio.to_thread(artwork.cache.set, image_url, data, response.headers)
+    return data
+
+
+async def download_colors(key, image_url, color_count, quality, engine):
+    try:
+        data = await download_artwork(image_url)
+
+        # Waiting for a pool slot blocks, so do it off the event loop
+        with metrics.span('palette_extract'):
+            future = await asyncio.to_thread(extractor.palette_pool.submit, data,
+                                             color_count, quality, engine)
+            swatches, decode_seconds, quantize_seconds = await asyncio.wrap_future(future)
+        record_stages(decode_seconds, quantize_seconds)
+
+        hex_colors = color_spaces.rgb_to_hex([rgb for rgb, _ in swatches])
+        swatches = [(color, count) for color, (_, count) in zip(hex_colors, swatches)]
+        # writes the store and may rebuild the color index grid
+        await asyncio.to_thread(remember_colors, key, swatches)
+        return swatches
+
+    except PaletteQueueFull:
+        raise
+
+    except Exception as e:
+        print(f"Error extracting colors: {e}")
+        metrics.FALLBACKS.inc(type(e).__name__)
+        return list(DEFAULT_SWATCHES)
+
+
+async def search_albums(query, headers, limit=1, user_token=False):
+    """Returns (data, status) of an album search, cached and coalesced by normalized query
+
+    User token searches are limited to the user's country and cached per token.
+    """
+    market = headers.get('Authorization') if user_token else None
+    key = (normalize_query(query), limit, market)
+    cached = extractor.search_cache.get(key)
+    if cached is not None:
+        return cached, 200
+
+    async def search():
+        with metrics.span('spotify_search'):
+            response = await fetch(f"{extractor.API_URL}/v1/search", headers=headers,
+                                   params={'q': query, 'type': 'album', 'limit': limit})
+        if response.status_code != 200:
+            return None, response.status_code
+        return response.json(), 200
+
+    data, status = await search_flights.do(key + (headers.get('Authorization'),), search)
+    if data is not None:
+        extractor.search_cache.set(key, data)
+    return data, status
+
+
+async def complete_album(album, headers):
+    """Returns (album_data, status), fetching the full album only when a field is missing"""
+    if has_album_fields(album):
+        return album, 200
+    return await fetch_album(album['id'], headers)
+
+
+async def fetch_album(album_id, headers):
+    """Returns (album_data, status) for an album ID, going through the album cache"""
+    cached = extractor.album_cache.get(album_id)
+    if cached is not None and cached.fresh:
+        return cached.album, 200
+
+    try:
+        with metrics.span('spotify_album'):
+            album_response = await fetch(f"{extractor.API_URL}/v1/albums/{album_id}",
+                                         headers=AlbumCache.conditional_headers(cached, headers))
+    except RateLimited:
+        return None, 429
+    if album_response.status_code == 304 and cached is not None:
+        extractor.album_cache.revalidated(album_id)
+        return cached.album, 200
+    if album_response.status_code != 200:
+        return None, album_response.status_code
+
+    album_data = album_response.json()
+    extractor.album_cache.set(album_id, album_data, album_response.headers.get('ETag'))
+    return album_data, 200
+
+
+async def album_palette(data, headers, engine, fields, stream=None):
+    """Shared tail of both search routes, returns (status, payload)"""
+    if 'albums' not in data or 'items' not in data['albums'] or len(data['albums']['items']) == 0:
+        return 404, {"error": "No albums found"}
+
+    if stream is not None:
+        events = stream_albums(data['albums']['items'], headers, engine, stream)
+        return 200, EventStream(events, STREAM_FORMATS[stream])
+
+    album_data, status = await complete_album(data['albums']['items'][0], headers)
+    if album_data is None:
+        return status, {"error": "Failed to get album details"}
+    if 'images' not in album_data or len(album_data['images']) == 0:
+        return 404, {"error": "No artwork available"}
+
+    summary, image_url = album_summary(album_data)
+    swatches = await extract_swatches(image_url, engine=engine)
+
+    return 200, {
+        "album": summary,
+        **palette_payload(swatches, fields)
+    }
+
+
+async def stream_albums(albums, headers, engine, stream):
+    """Search results as events: every album's details right away, then each palette as it finishes"""
+    palettes = {}
+    try:
+        for index, album in enumerate(albums):
+            album_data, status = await complete_album(album, headers)
+            if album_data is None or len(album_data.get('images', [])) == 0:
+                yield stream_event(stream, 'error', {"index": index, "album_id": album.get('id'),
+                                                     "error": "No album artwork available",
+                                                     "status": status if album_data is None else 404})
+                continue
+
+            summary, image_url = album_summary(album_data)
+            palettes[asyncio.ensure_future(extract_swatches(image_url, engine=engine))] = (index, album['id'])
+            yield stream_event(stream, 'album', {"index": index, "album_id": album['id'], "album": summary})
+
+        pending = set(palettes)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in sorted(done, key=lambda task: palettes[task][0]):
+                index, album_id = palettes[task]
+                try:
+                    colors = [color for color, _ in task.result()]
+                except PaletteQueueFull:
+                    yield stream_event(stream, 'error', {"index": index, "album_id": album_id,
+                                                         "error": "Too many palettes being extracted, try again shortly",
+                                                         "status": 503})
+                    continue
+                yield stream_event(stream, 'colors', {"index": index, "album_id": album_id, "colors": colors})
+
+        yield stream_event(stream, 'done', {"count": len(albums)})
+    finally:
+        # the client went away, palettes nobody is waiting for are dropped
+        for task in palettes:
+            task.cancel()
+
+
+async def limited_search_album(request):
+    query = request.args.get('q')
+    if query is None or query == "":
+        return 400, {"error": "No search query provided"}
+
+    engine = requested_engine(request)
+    if engine is None:
+        return 400, {"error": "Unknown palette engine"}
+
+    fields = requested_fields(request)
+    if fields is None:
+        return 400, {"error": f"fields must be some of {', '.join(PALETTE_FIELDS)}"}
+
+    stream, limit = requested_stream(request)
+    if limit is None:
+        return invalid_stream()
+
+    app_token = extractor.app_tokens.cached_token()
+    if app_token is None:
+        # Refreshes are rare and single-flight, a worker thread is fine for them
+        try:
+            app_token = await asyncio.to_thread(extractor.app_tokens.get_token)
+        except TokenError as e:
+            return e.status_code, {"error": str(e)}
+
+    headers = {'Authorization': f"Bearer {app_token}"}
+    data, status = await search_albums(query, headers, limit=limit)
+    if status == 401:
+        extractor.app_tokens.invalidate()
+    if status != 200:
+        return status, {"error": "Failed to search albums"}
+
+    return await album_palette(data, headers, engine, fields, stream)
+
+
+async def search_album(request):
+    if 'access_token' not in request.session:
+        return 401, {"error": "Not authenticated"}
+
+    query = request.args.get('q')
+    if query is None or query == "":
+        return 400, {"error": "No search query provided"}
+
+    engine = requested_engine(request)
+    if engine is None:
+        return 400, {"error": "Unknown palette engine"}
+
+    fields = requested_fields(request)
+    if fields is None:
+        return 400, {"error": f"fields must be some of {', '.join(PALETTE_FIELDS)}"}
+
+    stream, limit = requested_stream(request)
+    if limit is None:
+        return invalid_stream()
+
+    headers = {'Authorization': f"Bearer {request.session['access_token']}"}
+    data, status = await search_albums(query, headers, limit=limit, user_token=True)
+    if status != 200:
+        return status, {"error": "Failed to search albums"}
+
+    return await album_palette(data, headers, engine, fields, stream)
+
+
+async def get_current_track(request):
+    if 'access_token' not in request.session:
+        return 401, {"error": "Not authenticated"}
+
+    engine = requested_engine(request)
+    if engine is None:
+        return 400, {"error": "Unknown palette engine"}
+
+    fields = requested_fields(request)
+    if fields is None:
+        return 400, {"error": f"fields must be some of {', '.join(PALETTE_FIELDS)}"}
+
+    headers = {'Authorization': f"Bearer {request.session['access_token']}"}
+    with metrics.span('spotify_player'):
+        response = await fetch(f"{extractor.API_URL}/v1/me/player/currently-playing", headers=headers)
+
+    if response.status_code == 204:
+        return 404, {"error": "No track currently playing"}
+    if response.status_code != 200:
+        return response.status_code, {"error": "Failed to get current track"}
+
+    data = response.json()
+    if 'item' not in data:
+        return 404, {"error": "No track information available"}
+
+    album_data, status = await complete_album(data['item']['album'], headers)
+    if album_data is None:
+        return status, {"error": "Failed to get album details"}
+    if 'images' not in album_data or len(album_data['images']) == 0:
+        return 404, {"error": "No album artwork available"}
+
+    _, image_url = album_summary(album_data)
+    swatches = await extract_swatches(image_url, engine=engine)
+
+    return 200, {
+        "track": track_summary(data['item'], album_data, image_url),
+        **palette_payload(swatches, fields)
+    }
+
+
+ROUTES = {
+    '/search': search_album,
+    '/limited-search': limited_search_album,
+    '/current-track': get_current_track,
+}
+
+
+async def send_json(send, status, payload, extra_headers=(), head=False):
+    await send_body(send, status, json.dumps(payload).encode(), b'application/json', extra_headers, head)
+
+
+async def send_body(send, status, body, content_type, extra_headers=(), head=False):
+    """Sends a complete response, HEAD gets the same headers and no body"""
+    headers = [
+        (b'content-type', content_type),
+        (b'content-length', str(len(body)).encode()),
+        # same as CORS(app) on the Flask side
+        (b'access-control-allow-origin', b'*'),
+    ]
+    headers.extend(extra_headers)
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': b'' if head else body})
+
+
+async def send_stream(send, status, stream, extra_headers=(), head=False):
+    """Sends each event as soon as it is produced, HEAD only gets the headers"""
+    headers = [
+        (b'content-type', stream.content_type.encode()),
+        # no-cache and X-Accel-Buffering keep proxies from holding events back
+        (b'cache-control', b'no-cache'),
+        (b'x-accel-buffering', b'no'),
+        (b'access-control-allow-origin', b'*'),
+    ]
+    headers.extend(extra_headers)
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    try:
+        if not head:
+            async for event in stream.events:
+                await send({'type': 'http.response.body', 'body': event.encode(), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    except Exception as e:
+        # the status is already sent, all that is left is to end the response early
+        print(f"Error streaming response: {e}")
+    finally:
+        await stream.events.aclose()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await close_client()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    head = scope['method'] == 'HEAD'
+    if scope['path'] == '/metrics':
+        await send_body(send, 200, metrics.render().encode(), b'text/plain; version=0.0.4', head=head)
+        return
+
+    start = time.perf_counter()
+    metrics.start_request()
+    status, payload, extra_headers = await handle(scope)
+
+    route = scope['path'] if scope['path'] in ROUTES else 'unmatched'
+    header = metrics.finish_request(route, status, time.perf_counter() - start)
+    if header is not None:
+        extra_headers.append((b'server-timing', header.encode()))
+    if isinstance(payload, EventStream):
+        await send_stream(send, status, payload, extra_headers, head)
+    else:
+        await send_json(send, status, payload, extra_headers, head)
+
+
+async def handle(scope):
+    """Runs the route of a request, returns (status, payload, extra headers)"""
+    handler = ROUTES.get(scope['path'])
+    if handler is None:
+        return 404, {"error": "Not found"}, []
+    if scope['method'] not in ('GET', 'HEAD'):
+        return 405, {"error": "Method not allowed"}, []
+
+    try:
+        status, payload = await handler(Request(scope))
+    except PaletteQueueFull:
+        return 503, {"error": "Too many palettes being extracted, try again shortly"}, [(b'retry-after', b'1')]
+    except RateLimited as e:
+        retry_after = str(math.ceil(e.retry_after)).encode()
+        return 429, {"error": "Too many requests to Spotify, try again shortly"}, [(b'retry-after', retry_after)]
+    except Exception as e:
+        print(f"Error handling {scope['path']}: {e}")
+        return 500, {"error": "Internal server error"}, []
+    return status, payload, []
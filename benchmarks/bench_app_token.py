@@ -0,0 +1,68 @@
+"""Counts token endpoint calls made by AppTokenManager against a local stub.
+
+    python benchmarks/bench_app_token.py --searches 5000 --threads 16
+
+Every search used to POST to /api/token; with the manager the stub should see
+a single call for the whole run (tokens live for an hour).
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from spotify_auth import AppTokenManager
+
+
+class TokenHandler(BaseHTTPRequestHandler):
+    calls = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with TokenHandler.lock:
+            TokenHandler.calls += 1
+        # a real token call costs a TLS round trip, pretend it does here too
+        time.sleep(0.05)
+        body = b'{"access_token": "stub-token", "token_type": "Bearer", "expires_in": 3600}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--searches', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=16)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), TokenHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    token_url = f"http://127.0.0.1:{server.server_address[1]}/api/token"
+
+    manager = AppTokenManager('client-id', 'client-secret', token_url)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        list(pool.map(lambda _: manager.get_token(), range(args.searches)))
+    elapsed = time.perf_counter() - start
+
+    server.shutdown()
+
+    print(f"searches:             {args.searches}")
+    print(f"token endpoint calls: {TokenHandler.calls}")
+    print(f"manager stats:        {manager.stats()}")
+    print(f"total time:           {elapsed * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""ColorIndex queries against a brute force scan: latency and exactness.
+
+    python benchmarks/bench_color_index.py [--size 1000000] [--queries 50] [--k 10]
+
+Palettes are synthetic: five colors scattered around a random base color,
+like covers built around one hue. Queries mix one, two and three colors.
+Every query's distances must match a brute force scan over all palettes;
+the script exits with status 1 if any does not.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from color_index import ColorIndex
+from color_spaces import hex_to_rgb, rgb_to_lab
+
+
+def synthetic_palettes(size, seed=1):
+    rng = np.random.default_rng(seed)
+    base = rng.integers(0, 256, (size, 1, 3))
+    colors = np.clip(base + rng.normal(0, 40, (size, 5, 3)), 0, 255).astype(int)
+    return [['#%02x%02x%02x' % tuple(color) for color in palette] for palette in colors]
+
+
+def brute_force(index, query, k):
+    labs = index._labs[:len(index._keys)][index._alive[:len(index._keys)]]
+    distances = ColorIndex._distances(labs, rgb_to_lab(hex_to_rgb(query)).astype(np.float32))
+    return np.sort(distances)[:k]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--k', type=int, default=10)
+    args = parser.parse_args()
+
+    palettes = synthetic_palettes(args.size)
+    index = ColorIndex()
+    start = time.perf_counter()
+    index.add_many((f"cover-{i}", palette) for i, palette in enumerate(palettes))
+    build_time = time.perf_counter() - start
+
+    rng = np.random.default_rng(2)
+    by_length = {1: [], 2: [], 3: []}
+    brute_times = []
+    mismatches = 0
+    for n in range(args.queries):
+        length = 1 + n % 3
+        query = ['#%02x%02x%02x' % tuple(color) for color in rng.integers(0, 256, (length, 3))]
+
+        start = time.perf_counter()
+        matches = index.query(query, args.k)
+        by_length[length].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        expected = brute_force(index, query, args.k)
+        brute_times.append(time.perf_counter() - start)
+
+        if not np.allclose([distance for _, distance, _ in matches], expected, atol=1e-3):
+            mismatches += 1
+
+    print(f"palettes:    {args.size} (indexed in {build_time:.1f} s)")
+    for length, times in by_length.items():
+        if times:
+            print(f"{length} color(s):  {statistics.median(times) * 1000:8.2f} ms/query (median), "
+                  f"{max(times) * 1000:8.2f} ms max")
+    print(f"brute force: {statistics.median(brute_times) * 1000:8.2f} ms/query (median)")
+    print(f"scored:      {index.stats()['scored'] / args.queries:.0f} palettes/query on average")
+    print(f"mismatches:  {mismatches}")
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
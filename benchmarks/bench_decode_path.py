@@ -0,0 +1,82 @@
+"""Per-image CPU time of the old PNG round trip against the direct decode path.
+
+    python benchmarks/bench_decode_path.py [--images DIR] [--count 24]
+
+old:    PIL decode -> PNG encode -> ColorThief decodes the PNG again
+direct: reduced-scale JPEG decode -> MMCQ on the decoded pixels
+"""
+import argparse
+import io
+import os
+import statistics
+import sys
+import time
+
+from PIL import Image
+from colorthief import ColorThief
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from corpus import load_corpus
+from palette_engines import decode_image, extract_palette
+
+
+def old_path(data, color_count, quality):
+    img = Image.open(io.BytesIO(data))
+    temp_img = io.BytesIO()
+    img.save(temp_img, format='PNG')
+    temp_img.seek(0)
+    return ColorThief(temp_img).get_palette(color_count=color_count, quality=quality)
+
+
+def direct_path(data, color_count, quality):
+    img, original_size = decode_image(data)
+    return extract_palette(img, color_count=color_count, quality=quality,
+                           original_size=original_size, engine='colorthief')
+
+
+def measure(path, corpus, color_count, quality, rounds):
+    timings = []
+    palettes = []
+    for _, data in corpus:
+        best = None
+        for _ in range(rounds):
+            start = time.process_time()
+            palette = path(data, color_count, quality)
+            elapsed = time.process_time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings.append(best)
+        palettes.append(palette)
+    return timings, palettes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', help='directory of covers, defaults to the synthetic corpus')
+    parser.add_argument('--count', type=int, default=24)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--colors', type=int, default=5)
+    parser.add_argument('--quality', type=int, default=10)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.images, args.count)
+
+    old_times, old_palettes = measure(old_path, corpus, args.colors, args.quality, args.rounds)
+    new_times, new_palettes = measure(direct_path, corpus, args.colors, args.quality, args.rounds)
+
+    # distance from each old swatch to the closest new one, to show quality is kept
+    drift = statistics.mean(
+        min(sum((a - b) ** 2 for a, b in zip(old_rgb, new_rgb)) ** 0.5 for new_rgb in new)
+        for old, new in zip(old_palettes, new_palettes)
+        for old_rgb in old
+    )
+
+    print(f"images:        {len(corpus)}")
+    print(f"old path:      {statistics.median(old_times) * 1000:8.2f} ms CPU/image (median)")
+    print(f"direct path:   {statistics.median(new_times) * 1000:8.2f} ms CPU/image (median)")
+    print(f"speedup:       {statistics.median(old_times) / statistics.median(new_times):8.1f}x")
+    print(f"palette drift: {drift:8.2f} mean RGB distance to nearest swatch")
+
+
+if __name__ == '__main__':
+    main()
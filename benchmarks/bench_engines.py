@@ -0,0 +1,77 @@
+"""Latency and perceptual quality of every palette engine on a fixed corpus.
+
+    python benchmarks/bench_engines.py [--images DIR] [--count 24] [--json results.json]
+
+Quality is the mean CIE76 color difference (delta E in CIELAB) between each
+sampled pixel and the closest color of its palette, i.e. how far the image
+drifts when repainted with only the palette. Lower is better; a delta E
+around 2 is barely noticeable.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from color_spaces import rgb_to_lab
+from corpus import load_corpus
+from palette_engines import ENGINES, decode_image, extract_palette, valid_pixels
+
+
+def palette_delta_e(pixels, palette):
+    pixels_lab = rgb_to_lab(pixels)
+    palette_lab = rgb_to_lab(np.array(palette))
+    distances = np.sqrt(((pixels_lab[:, None, :] - palette_lab[None, :, :]) ** 2).sum(axis=2))
+    return float(distances.min(axis=1).mean())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', help='directory of covers, defaults to the synthetic corpus')
+    parser.add_argument('--count', type=int, default=24)
+    parser.add_argument('--colors', type=int, default=5)
+    parser.add_argument('--quality', type=int, default=10)
+    parser.add_argument('--engines', default=','.join(ENGINES))
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    decoded = []
+    for name, data in load_corpus(args.images, args.count):
+        image, original_size = decode_image(data)
+        image.load()
+        decoded.append((image, original_size, valid_pixels(image, args.quality, original_size)))
+
+    results = {}
+    for engine in args.engines.split(','):
+        latencies = []
+        scores = []
+        for image, original_size, pixels in decoded:
+            start = time.perf_counter()
+            palette = extract_palette(image, args.colors, args.quality, original_size, engine)
+            latencies.append(time.perf_counter() - start)
+            scores.append(palette_delta_e(pixels, palette))
+        results[engine] = {
+            'latency_ms_p50': statistics.median(latencies) * 1000,
+            'latency_ms_max': max(latencies) * 1000,
+            'delta_e_mean': statistics.mean(scores),
+        }
+
+    print(f"{len(decoded)} images, {args.colors} colors, quality {args.quality}")
+    print(f"{'engine':<12} {'p50 ms':>9} {'max ms':>9} {'delta E':>9}")
+    for engine, result in results.items():
+        print(f"{engine:<12} {result['latency_ms_p50']:>9.2f} {result['latency_ms_max']:>9.2f} "
+              f"{result['delta_e_mean']:>9.2f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'images': len(decoded), 'colors': args.colors, 'quality': args.quality,
+                       'engines': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
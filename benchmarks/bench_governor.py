@@ -0,0 +1,99 @@
+"""Spotify calls against a rate limited stub, with and without the http_client governor.
+
+    python benchmarks/bench_governor.py [--quota 100] [--threads 64] [--seconds 30]
+
+The stub answers 429 with Retry-After once more than --quota API calls
+arrive within a second. --threads threads search in a loop, a quarter of
+them at interactive priority and the rest as background work. Without the
+governor every thread retries on its own and the calls arrive in bursts;
+with it, throughput should stay close to the quota with few 429s, and the
+interactive calls should go first: background calls wait longer or give
+up with RateLimited.
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import http_client
+from stub_spotify import start_stub
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def run(label, state, threads, seconds):
+    latencies = {http_client.INTERACTIVE: [], http_client.BACKGROUND: []}
+    outcomes = {http_client.INTERACTIVE: {}, http_client.BACKGROUND: {}}
+    lock = threading.Lock()
+    stop = time.monotonic() + seconds
+
+    def worker(level):
+        with http_client.priority(level):
+            while time.monotonic() < stop:
+                start = time.perf_counter()
+                try:
+                    status = http_client.get(f"{state.base_url}/v1/search",
+                                             params={'q': 'benchmark', 'type': 'album', 'limit': 1}).status_code
+                except http_client.RateLimited:
+                    status = 'rate limited'
+                with lock:
+                    outcomes[level][status] = outcomes[level].get(status, 0) + 1
+                    if status == 200:
+                        latencies[level].append(time.perf_counter() - start)
+
+    with state.lock:
+        throttled_before = state.calls.get('429', 0)
+    workers = [threading.Thread(target=worker, args=(http_client.INTERACTIVE if i % 4 == 0 else http_client.BACKGROUND,))
+               for i in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    with state.lock:
+        throttled = state.calls.get('429', 0) - throttled_before
+
+    succeeded = sum(counts.get(200, 0) for counts in outcomes.values())
+    print(f"{label}")
+    print(f"  {succeeded / elapsed:8.1f} successful calls/s of a {state.quota}/s quota, "
+          f"{throttled / elapsed:8.1f} 429s/s from the stub")
+    for level, name in ((http_client.INTERACTIVE, 'interactive'), (http_client.BACKGROUND, 'background')):
+        times = latencies[level]
+        counts = ', '.join(f"{status}: {count}" for status, count in sorted(outcomes[level].items(), key=str))
+        print(f"  {name:<12} p50 {statistics.median(times) * 1000 if times else 0:8.1f} ms  "
+              f"p95 {percentile(times, 0.95) * 1000:8.1f} ms  ({counts})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--quota', type=int, default=100, help='stub API calls per second')
+    parser.add_argument('--threads', type=int, default=64)
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--latency', type=float, default=20, help='stub latency in ms')
+    args = parser.parse_args()
+
+    server, state = start_stub(latency=args.latency / 1000, quota=args.quota)
+    try:
+        run('retries only (no governor)', state, args.threads, args.seconds)
+        # let the stub's window empty before the second run
+        time.sleep(1)
+        http_client.govern(state.base_url, 'benchmark')
+        run('governed', state, args.threads, args.seconds)
+        print(f"  final concurrency limit: {http_client.governor_for(state.base_url).stats()['limit']:.1f}")
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
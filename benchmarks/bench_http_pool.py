@@ -0,0 +1,74 @@
+"""Compares one-off requests.get calls with the pooled http_client.
+
+    python benchmarks/bench_http_pool.py --requests 2000 --threads 16
+
+A local keep-alive stub counts how many TCP connections each client opens;
+plain requests opens one per call, the pooled client at most one per thread.
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import http_client
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    connections = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        with StubHandler.lock:
+            StubHandler.connections += 1
+
+    def do_GET(self):
+        body = b'{"albums": {"items": []}}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run(label, fetch, url, total, threads):
+    StubHandler.connections = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        statuses = list(pool.map(lambda _: fetch(url).status_code, range(total)))
+    elapsed = time.perf_counter() - start
+    assert all(status == 200 for status in statuses)
+    print(f"{label:<14} {total / elapsed:>9.0f} req/s  {StubHandler.connections:>6} connections")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=16)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/v1/search"
+
+    http_client.configure(pool_size=args.threads)
+
+    run('requests.get', requests.get, url, args.requests, args.threads)
+    run('http_client', http_client.get, url, args.requests, args.threads)
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""Palette throughput with extraction inline on threads versus the process pool.
+
+    python benchmarks/bench_palette_pool.py [--threads 16] [--workers N]
+
+Inline extraction holds the GIL, so request threads take turns and
+throughput stays near one core; the pool should scale with --workers.
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from corpus import load_corpus
+from palette_pool import PalettePool
+
+
+def run(label, pool, corpus, total, threads, engine):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as requests:
+        list(requests.map(lambda i: pool.extract(corpus[i % len(corpus)][1], engine=engine), range(total)))
+    elapsed = time.perf_counter() - start
+    print(f"{label:<22} {total / elapsed:>8.1f} palettes/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', help='directory of covers, defaults to the synthetic corpus')
+    parser.add_argument('--count', type=int, default=400, help='palettes to extract per run')
+    parser.add_argument('--threads', type=int, default=16, help='concurrent request threads')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--engine', default='median-cut')
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.images, 24)
+
+    run('inline (threads only)', PalettePool(workers=0, queue_size=args.threads),
+        corpus, args.count, args.threads, args.engine)
+
+    pool = PalettePool(workers=args.workers, queue_size=args.threads * 2, queue_timeout=60)
+    pool.start()
+    run(f"process pool ({args.workers} workers)", pool, corpus, args.count, args.threads, args.engine)
+    pool.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Vectorized median cut against ColorThief's MMCQ: speed and equivalence.
+
+    python benchmarks/bench_quantizer.py [--images DIR] [--count 24] [--tolerance 2]
+
+Both quantizers see the same decoded, sampled pixels. Every swatch of the
+NumPy palette must be within --tolerance per channel of the ColorThief swatch
+at the same position; the script exits with status 1 if any image is not.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from corpus import load_corpus
+from palette_engines import decode_image, extract_palette
+
+
+def timed(function, *args, rounds=3):
+    best = None
+    for _ in range(rounds):
+        start = time.process_time()
+        result = function(*args)
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def equivalent(reference, palette, tolerance):
+    if len(reference) != len(palette):
+        return False
+    return all(abs(a - b) <= tolerance
+               for expected, actual in zip(reference, palette)
+               for a, b in zip(expected, actual))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', help='directory of covers, defaults to the synthetic corpus')
+    parser.add_argument('--count', type=int, default=24)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--colors', type=int, default=5)
+    parser.add_argument('--quality', type=int, default=10)
+    parser.add_argument('--tolerance', type=int, default=2)
+    args = parser.parse_args()
+
+    reference_times = []
+    numpy_times = []
+    mismatches = []
+
+    for name, data in load_corpus(args.images, args.count):
+        image, original_size = decode_image(data)
+        image.load()
+        reference, reference_time = timed(extract_palette, image, args.colors, args.quality,
+                                          original_size, 'colorthief', rounds=args.rounds)
+        palette, numpy_time = timed(extract_palette, image, args.colors, args.quality,
+                                    original_size, 'median-cut', rounds=args.rounds)
+        reference_times.append(reference_time)
+        numpy_times.append(numpy_time)
+        if not equivalent(reference, palette, args.tolerance):
+            mismatches.append((name, reference, palette))
+
+    print(f"images:      {len(reference_times)}")
+    print(f"colorthief:  {statistics.median(reference_times) * 1000:8.2f} ms CPU/image (median)")
+    print(f"numpy:       {statistics.median(numpy_times) * 1000:8.2f} ms CPU/image (median)")
+    print(f"speedup:     {statistics.median(reference_times) / statistics.median(numpy_times):8.1f}x")
+    print(f"mismatches:  {len(mismatches)} (tolerance {args.tolerance} per channel)")
+    for name, reference, palette in mismatches:
+        print(f"  {name}: colorthief={reference} numpy={palette}")
+
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Import-to-first-request latency of the Flask app, measured in fresh processes.
+
+    python benchmarks/bench_startup.py [--runs 10] [--path / --path /limited]
+
+Each run starts a new interpreter in an empty directory, imports
+spotify_color_extractor, builds the app with create_app() and answers a
+request for the first --path through the test client, then one for each
+of the others, so every page template gets rendered. Reported per stage
+as the median over all runs, plus the whole process from spawn to exit.
+The script also checks that no run left files behind in its working
+directory and exits with status 1 if one did, or if any request did not
+succeed.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Runs in the child process, prints its timings as JSON
+CHILD = '''
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import spotify_color_extractor
+imported = time.perf_counter()
+app = spotify_color_extractor.create_app()
+created = time.perf_counter()
+client = app.test_client()
+statuses = {sys.argv[2]: client.get(sys.argv[2]).status_code}
+answered = time.perf_counter()
+statuses.update((path, client.get(path).status_code) for path in sys.argv[3:])
+print(json.dumps({
+    "import": imported - start,
+    "create_app": created - imported,
+    "first_request": answered - created,
+    "total": answered - start,
+    "statuses": statuses,
+}))
+'''
+
+
+def run_once(paths):
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', CHILD, os.path.abspath(ROOT)] + paths,
+                                cwd=directory, capture_output=True, text=True, check=True).stdout
+        process = time.perf_counter() - start
+        timings = json.loads(output.strip().splitlines()[-1])
+        timings['process'] = process
+        timings['written'] = sorted(os.listdir(directory))
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--path', action='append', dest='paths',
+                        help='route to request, the first one is timed (default: / and /limited)')
+    args = parser.parse_args()
+    paths = args.paths or ['/', '/limited']
+
+    # the first run warms the bytecode cache, it is not counted
+    run_once(paths)
+    runs = [run_once(paths) for _ in range(args.runs)]
+
+    for stage in ('import', 'create_app', 'first_request', 'total', 'process'):
+        times = [run[stage] for run in runs]
+        print(f"{stage:14} {statistics.median(times) * 1000:8.1f} ms (median), {max(times) * 1000:8.1f} ms max")
+
+    failed = [run for run in runs if any(status >= 400 for status in run['statuses'].values())]
+    written = sorted({name for run in runs for name in run['written']})
+    for path in paths:
+        print(f"status {path:8} {', '.join(sorted({str(run['statuses'][path]) for run in runs}))}")
+    print(f"files written: {', '.join(written) or 'none'}")
+    sys.exit(1 if failed or written else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""Fixed corpus of synthetic album covers shared by the benchmarks.
+
+Covers are generated from a seed, so every run (and every revision) sees
+exactly the same pixels without shipping image files. Pass a directory to
+load real artwork instead.
+"""
+import io
+import os
+import random
+
+from PIL import Image, ImageDraw, ImageFilter
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+def synthetic_cover(seed, size=640):
+    rng = random.Random(seed)
+    base = tuple(rng.randrange(256) for _ in range(3))
+    image = Image.new('RGB', (size, size), base)
+    draw = ImageDraw.Draw(image)
+
+    # a handful of large shapes gives a few dominant colors, like real covers
+    for _ in range(rng.randint(3, 7)):
+        color = tuple(rng.randrange(256) for _ in range(3))
+        x0, y0 = rng.randrange(size), rng.randrange(size)
+        x1, y1 = x0 + rng.randrange(size // 4, size), y0 + rng.randrange(size // 4, size)
+        if rng.random() < 0.5:
+            draw.rectangle((x0, y0, x1, y1), fill=color)
+        else:
+            draw.ellipse((x0, y0, x1, y1), fill=color)
+
+    # soften edges and add grain so the histogram is not just a few exact colors
+    image = image.filter(ImageFilter.GaussianBlur(rng.uniform(1, 6)))
+    noise = Image.effect_noise((size, size), rng.uniform(4, 20)).convert('RGB')
+    image = Image.blend(image, noise, 0.08)
+
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def load_corpus(directory=None, count=24, size=640, seed=1234):
+    """Return a list of (name, jpeg_bytes) pairs"""
+    if directory:
+        names = sorted(name for name in os.listdir(directory)
+                       if name.lower().endswith(IMAGE_EXTENSIONS))
+        corpus = []
+        for name in names[:count] if count else names:
+            with open(os.path.join(directory, name), 'rb') as f:
+                corpus.append((name, f.read()))
+        return corpus
+
+    return [(f"cover-{seed + i}.jpg", synthetic_cover(seed + i, size)) for i in range(count)]
@@ -0,0 +1,86 @@
+"""Closed-loop HTTP load generator for the Flask and asyncio apps.
+
+    python benchmarks/load.py http://127.0.0.1:5001 /limited-search?q=album{n} \\
+        --concurrency 200 --requests 5000 --distinct 50
+
+{n} in the path is replaced by a number below --distinct, so the run mixes
+cache hits and misses. Pass --cookie to drive the logged-in routes.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import httpx
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def drive(base_url, path, total, concurrency, distinct=1, cookie=None, timeout=60):
+    """Send `total` requests with `concurrency` in flight, returns a result dict"""
+    latencies = []
+    statuses = {}
+    errors = 0
+    counter = iter(range(total))
+
+    headers = {'Cookie': cookie} if cookie else {}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, headers=headers, limits=limits,
+                                 timeout=timeout) as client:
+        async def worker():
+            nonlocal errors
+            for n in counter:
+                start = time.perf_counter()
+                try:
+                    response = await client.get(path.replace('{n}', str(n % distinct)))
+                    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+                except httpx.HTTPError:
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    return {
+        'requests': total,
+        'concurrency': concurrency,
+        'elapsed_s': elapsed,
+        'throughput_rps': len(latencies) / elapsed if elapsed else 0.0,
+        'latency_ms': {
+            'mean': statistics.mean(latencies) * 1000 if latencies else 0.0,
+            'p50': percentile(latencies, 0.50) * 1000,
+            'p95': percentile(latencies, 0.95) * 1000,
+            'p99': percentile(latencies, 0.99) * 1000,
+            'max': max(latencies) * 1000 if latencies else 0.0,
+        },
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'errors': errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('base_url')
+    parser.add_argument('path')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--distinct', type=int, default=1, help='distinct values for {n}')
+    parser.add_argument('--cookie', help='Cookie header, e.g. session=...')
+    args = parser.parse_args()
+
+    result = asyncio.run(drive(args.base_url, args.path, args.requests, args.concurrency,
+                               args.distinct, args.cookie))
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
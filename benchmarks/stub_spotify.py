@@ -0,0 +1,227 @@
+"""Local stand-in for accounts.spotify.com, api.spotify.com and the image CDN.
+
+    python benchmarks/stub_spotify.py --port 8900 --latency 40
+
+then start the app against it:
+
+    SPOTIFY_ACCOUNTS_URL=http://127.0.0.1:8900 SPOTIFY_API_URL=http://127.0.0.1:8900 \\
+        python spotify_color_extractor.py
+
+Albums are derived from the search query, so the same query always returns
+the same album, and their covers come from the fixed benchmark corpus served
+under /images/ with ETags. Every response is delayed by --latency milliseconds
+(--image-latency for artwork) to mimic the real round trip. With --quota, API
+calls beyond that many per second are answered 429 with a Retry-After, like
+Spotify's rate limit.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from corpus import load_corpus
+
+
+class StubState:
+    """Corpus, latency settings and per-route call counters of one stub"""
+
+    def __init__(self, corpus, latency=0.0, image_latency=None, quota=0):
+        self.corpus = corpus
+        self.latency = latency
+        self.image_latency = latency if image_latency is None else image_latency
+        self.quota = quota
+        self.base_url = ''
+        self.lock = threading.Lock()
+        self.calls = {}
+        self._accepted = deque()
+
+    def count(self, route):
+        with self.lock:
+            self.calls[route] = self.calls.get(route, 0) + 1
+
+    def over_quota(self):
+        """Whether an API call goes over the quota of the last second, counted as accepted if not"""
+        if not self.quota:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            while self._accepted and self._accepted[0] <= now - 1:
+                self._accepted.popleft()
+            if len(self._accepted) >= self.quota:
+                return True
+            self._accepted.append(now)
+            return False
+
+
+def album_number(text):
+    return int(hashlib.sha1(text.encode()).hexdigest()[:8], 16)
+
+
+def album_for(state, album_id):
+    number = album_number(album_id)
+    cover = number % len(state.corpus)
+    return {
+        'id': album_id,
+        'name': f"Stub Album {album_id[:6]}",
+        'album_type': 'album',
+        'artists': [{'id': f"artist{number % 97}", 'name': f"Stub Artist {number % 97}"}],
+        'release_date': f"{1970 + number % 55}-0{1 + number % 9}-1{number % 10}",
+        'images': [
+            {'url': f"{state.base_url}/images/{cover}.jpg", 'width': 640, 'height': 640},
+            {'url': f"{state.base_url}/images/{cover}.jpg?size=300", 'width': 300, 'height': 300},
+        ],
+    }
+
+
+def album_id_for_query(query):
+    return hashlib.sha1(query.strip().lower().encode()).hexdigest()[:22]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state = None
+
+    def send_json(self, payload, status=200, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        path = urlparse(self.path).path
+        if path == '/api/token':
+            self.state.count('token')
+            time.sleep(self.state.latency)
+            self.send_json({'access_token': 'stub-token', 'token_type': 'Bearer', 'expires_in': 3600})
+        else:
+            self.send_json({'error': 'not found'}, 404)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        args = {name: values[0] for name, values in parse_qs(url.query).items()}
+        state = self.state
+
+        if url.path.startswith('/images/'):
+            time.sleep(state.image_latency)
+            index = int(url.path.rsplit('/', 1)[1].split('.')[0]) % len(state.corpus)
+            etag = f'"cover-{index}"'
+            if self.headers.get('If-None-Match') == etag:
+                state.count('image-304')
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            state.count('image')
+            body = state.corpus[index][1]
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        time.sleep(state.latency)
+
+        if url.path.startswith('/v1/') and state.over_quota():
+            state.count('429')
+            self.send_json({'error': {'status': 429, 'message': 'API rate limit exceeded'}}, 429,
+                           headers={'Retry-After': '1'})
+        elif url.path == '/v1/search':
+            state.count('search')
+            limit = int(args.get('limit', 20))
+            query = args.get('q', '')
+            items = [album_for(state, album_id_for_query(query if i == 0 else f"{query}#{i}"))
+                     for i in range(limit)]
+            self.send_json({'albums': {'items': items, 'limit': limit, 'total': limit}})
+        elif url.path == '/v1/albums':
+            state.count('albums')
+            ids = [album_id for album_id in args.get('ids', '').split(',') if album_id][:20]
+            self.send_json({'albums': [album_for(state, album_id) for album_id in ids]})
+        elif url.path.startswith('/v1/albums/'):
+            album_id = url.path.rsplit('/', 1)[1]
+            etag = f'"{album_id_for_query(album_id)[:16]}"'
+            if self.headers.get('If-None-Match') == etag:
+                state.count('album-304')
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            state.count('album')
+            self.send_json(album_for(state, album_id), headers={'ETag': etag})
+        elif url.path == '/v1/me/player/currently-playing':
+            state.count('currently-playing')
+            # the track changes every 30 seconds, like someone listening
+            album_id = album_id_for_query(f"playing-{int(time.time() // 30)}")
+            self.send_json({'is_playing': True, 'item': {
+                'name': f"Stub Track {album_id[:4]}",
+                'album': album_for(state, album_id),
+                'artists': album_for(state, album_id)['artists'],
+            }})
+        elif url.path == '/v1/me/player/recently-played':
+            state.count('recently-played')
+            # a listening history that keeps returning to a dozen albums
+            limit = min(int(args.get('limit', 20)), 50)
+            items = []
+            for i in range(limit):
+                album = album_for(state, album_id_for_query(f"recent-{i % 12}"))
+                items.append({
+                    'played_at': f"2025-01-01T{i // 60:02d}:{i % 60:02d}:00.000Z",
+                    'track': {'name': f"Stub Track {i}", 'album': album, 'artists': album['artists']},
+                })
+            self.send_json({'items': items, 'limit': limit})
+        else:
+            self.send_json({'error': 'not found'}, 404)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub(port=0, latency=0.0, image_latency=None, images=None, corpus_size=24, quota=0):
+    """Start a stub in a background thread, returns (server, state)"""
+    state = StubState(load_corpus(images, corpus_size), latency, image_latency, quota)
+    handler = type('BoundStubHandler', (StubHandler,), {'state': state})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    state.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency', type=float, default=40, help='API latency in ms')
+    parser.add_argument('--image-latency', type=float, help='CDN latency in ms, defaults to --latency')
+    parser.add_argument('--images', help='directory of covers, defaults to the synthetic corpus')
+    parser.add_argument('--quota', type=int, default=0, help='API calls per second before 429s, 0 for no limit')
+    args = parser.parse_args()
+
+    image_latency = None if args.image_latency is None else args.image_latency / 1000
+    server, state = start_stub(args.port, args.latency / 1000, image_latency, args.images, quota=args.quota)
+    print(f"Stub Spotify listening on {state.base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(f"calls: {state.calls}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+"""End-to-end benchmark of the app against the local Spotify stub, saved as JSON.
+
+    python benchmarks/suite.py [--app flask|async] [--concurrency 1 10 50] \\
+        [--requests 500] [--output results.json] [--compare baseline.json]
+
+Starts stub_spotify.py in this process (accounts, API and the image CDN
+serving the fixed cover corpus, with --latency and --image-latency), then
+for every route and concurrency level starts a fresh app process against
+it, so each run begins with cold caches, and drives it with load.py. {n}
+in a route is replaced by a number below --distinct, which sets how many
+requests hit the caches. Every run reports throughput, latency
+percentiles, the CPU time and peak RSS of the app process and its palette
+workers (read from /proc, null on other platforms) and the calls the
+stub answered. The results are written with the git revision and machine
+details; --compare prints the change against an earlier file and exits
+with status 1 when any run lost more than --threshold of its throughput
+or p95.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+from flask import Flask
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from load import drive
+from stub_spotify import start_stub
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+ROUTES = {
+    'search': '/search?q=album{n}',
+    'limited-search': '/limited-search?q=album{n}',
+    'current-track': '/current-track',
+}
+
+SECRET_KEY = 'benchmark-suite'
+
+# Runs in the app process: argv is the repository, the app and the port
+CHILD = '''
+import sys
+sys.path.insert(0, sys.argv[1])
+if sys.argv[2] == 'flask':
+    import spotify_color_extractor
+    spotify_color_extractor.create_app().run(host='127.0.0.1', port=int(sys.argv[3]), threaded=True)
+else:
+    import uvicorn
+    uvicorn.run('async_app:app', host='127.0.0.1', port=int(sys.argv[3]), log_level='warning')
+'''
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def session_cookie():
+    """A signed Flask session holding a user token, accepted by both apps"""
+    app = Flask(__name__)
+    app.secret_key = SECRET_KEY
+    value = app.session_interface.get_signing_serializer(app).dumps({'access_token': 'stub-user'})
+    return f"session={value}"
+
+
+def revision():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if dirty else '')
+
+
+def process_tree(pid):
+    """CPU seconds and RSS bytes of pid and all its descendants, None without /proc"""
+    ticks = os.sysconf('SC_CLK_TCK')
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    stats = {}
+    try:
+        names = os.listdir('/proc')
+    except OSError:
+        return None
+    for name in names:
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as file:
+                # the command name may hold spaces, the fields start after its closing parenthesis
+                fields = file.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        stats[int(name)] = fields
+    if pid not in stats:
+        return None
+
+    children = {}
+    for child, fields in stats.items():
+        children.setdefault(int(fields[1]), []).append(child)
+    cpu = rss = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        fields = stats[current]
+        # utime, stime and the time of reaped children, then resident pages
+        cpu += sum(int(value) for value in fields[11:15])
+        rss += int(fields[21]) * page_size
+        pending.extend(children.get(current, ()))
+    return cpu / ticks, rss
+
+
+class Sampler:
+    """Polls process_tree in a thread, keeping the first and last CPU time and the peak RSS"""
+
+    def __init__(self, pid, interval=0.1):
+        self.pid = pid
+        self.interval = interval
+        self.first = self.last = process_tree(pid)
+        self.peak_rss = self.first[1] if self.first else None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        current = process_tree(self.pid)
+        if current is not None:
+            self.last = current
+            self.peak_rss = max(self.peak_rss or 0, current[1])
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        if self.first is None or self.last is None:
+            return None
+        return self.last[0] - self.first[0], self.peak_rss
+
+
+class AppProcess:
+    """The Flask or asyncio app in a child process, pointed at the stub"""
+
+    def __init__(self, app, stub_url, environment):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.directory = tempfile.TemporaryDirectory()
+        self.log = open(os.path.join(self.directory.name, 'app.log'), 'w+')
+        env = dict(os.environ, SPOTIFY_ACCOUNTS_URL=stub_url, SPOTIFY_API_URL=stub_url,
+                   SPOTIFY_CLIENT_ID='benchmark', SPOTIFY_CLIENT_SECRET='benchmark',
+                   FLASK_SECRET_KEY=SECRET_KEY, PALETTE_STORE='memory',
+                   ARTWORK_CACHE_DIR=os.path.join(self.directory.name, 'artwork-cache'))
+        env.update(environment)
+        # an empty working directory, so nothing is left behind and no credentials.env is picked up
+        self.process = subprocess.Popen([sys.executable, '-c', CHILD, ROOT, app, str(self.port)],
+                                        cwd=self.directory.name, env=env,
+                                        stdout=self.log, stderr=subprocess.STDOUT)
+
+    def wait_ready(self, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                break
+            try:
+                httpx.get(f"{self.url}/metrics", timeout=1)
+                return
+            except httpx.HTTPError:
+                time.sleep(0.1)
+        self.log.seek(0)
+        output = self.log.read()
+        self.stop()
+        raise SystemExit(f"The app did not start:\n{output[-2000:]}")
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.log.close()
+        self.directory.cleanup()
+
+
+def run(args, state, route, concurrency, cookie):
+    app = AppProcess(args.app, state.base_url, dict(args.env))
+    try:
+        app.wait_ready()
+        with state.lock:
+            calls_before = dict(state.calls)
+        sampler = Sampler(app.process.pid)
+        result = asyncio.run(drive(app.url, ROUTES[route], args.requests, concurrency,
+                                   args.distinct, cookie))
+        usage = sampler.stop()
+    finally:
+        app.stop()
+
+    with state.lock:
+        calls = {name: count - calls_before.get(name, 0) for name, count in sorted(state.calls.items())}
+    result = dict({'route': route, 'path': ROUTES[route]}, **result)
+    result['cpu_s'] = usage[0] if usage else None
+    # CPU per wall clock second, above 100 when palette workers run in parallel
+    result['cpu_percent'] = usage[0] / result['elapsed_s'] * 100 if usage else None
+    result['peak_rss_mb'] = usage[1] / 2 ** 20 if usage else None
+    result['upstream_calls'] = {name: count for name, count in calls.items() if count}
+    return result
+
+
+def compare(results, baseline, threshold):
+    """Prints each run's change against the baseline, returns whether any regressed"""
+    previous = {(run['route'], run['concurrency']): run for run in baseline['runs']}
+    print(f"\nagainst {baseline.get('revision') or 'baseline'}:")
+    if baseline.get('settings') != results['settings'] or baseline.get('machine') != results['machine']:
+        print("warning: the baseline ran with other settings or on another machine")
+    regressed = False
+    for run in results['runs']:
+        before = previous.get((run['route'], run['concurrency']))
+        if before is None:
+            continue
+        throughput = run['throughput_rps'] / before['throughput_rps'] - 1 if before['throughput_rps'] else 0.0
+        p95 = run['latency_ms']['p95'] / before['latency_ms']['p95'] - 1 if before['latency_ms']['p95'] else 0.0
+        worse = throughput < -threshold or p95 > threshold
+        regressed = regressed or worse
+        print(f"{run['route']:<15} c={run['concurrency']:<5} throughput {throughput:+7.1%}  "
+              f"p95 {p95:+7.1%}{'  REGRESSED' if worse else ''}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--app', choices=('flask', 'async'), default='flask')
+    parser.add_argument('--routes', nargs='+', choices=sorted(ROUTES), default=list(ROUTES))
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 50])
+    parser.add_argument('--requests', type=int, default=500, help='requests per route and concurrency level')
+    parser.add_argument('--distinct', type=int, default=50, help='distinct values for {n}')
+    parser.add_argument('--latency', type=float, default=40, help='stub API latency in ms')
+    parser.add_argument('--image-latency', type=float, help='stub CDN latency in ms, defaults to --latency')
+    parser.add_argument('--images', help='directory of covers, defaults to the synthetic corpus')
+    parser.add_argument('--corpus-size', type=int, default=24)
+    parser.add_argument('--env', action='append', default=[], type=lambda value: value.split('=', 1),
+                        metavar='NAME=VALUE', help='extra environment for the app, e.g. PALETTE_WORKERS=2')
+    parser.add_argument('--output', help='JSON file to write, defaults to benchmark-<revision>.json')
+    parser.add_argument('--compare', help='earlier results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='throughput loss or p95 growth counted as a regression')
+    args = parser.parse_args()
+
+    image_latency = None if args.image_latency is None else args.image_latency / 1000
+    server, state = start_stub(0, args.latency / 1000, image_latency, args.images, args.corpus_size)
+    cookie = session_cookie()
+
+    results = {
+        'revision': revision(),
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'machine': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'settings': {
+            'app': args.app,
+            'requests': args.requests,
+            'distinct': args.distinct,
+            'latency_ms': args.latency,
+            'image_latency_ms': args.latency if args.image_latency is None else args.image_latency,
+            'images': args.images,
+            'corpus_size': args.corpus_size,
+            'env': dict(args.env),
+        },
+        'runs': [],
+    }
+    try:
+        for route in args.routes:
+            for concurrency in args.concurrency:
+                result = run(args, state, route, concurrency, cookie)
+                results['runs'].append(result)
+                latency = result['latency_ms']
+                cpu = f"{result['cpu_percent']:5.0f}%" if result['cpu_percent'] is not None else '    -'
+                rss = f"{result['peak_rss_mb']:6.0f} MB" if result['peak_rss_mb'] is not None else '     -'
+                print(f"{route:<15} c={concurrency:<5} {result['throughput_rps']:8.1f} req/s  "
+                      f"p50 {latency['p50']:7.1f}  p95 {latency['p95']:7.1f}  p99 {latency['p99']:7.1f} ms  "
+                      f"cpu {cpu}  rss {rss}  statuses {result['statuses']}", flush=True)
+    finally:
+        server.shutdown()
+
+    name = results['revision'] or 'unknown'
+    output = args.output or f"benchmark-{name[:12]}{'-dirty' if name.endswith('-dirty') else ''}.json"
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f"results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        sys.exit(1 if compare(results, baseline, args.threshold) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+"""Extract palettes of artwork already on disk, no Spotify or downloads involved.
+
+    python bulk_extract.py covers/ --output palettes.jsonl
+    python bulk_extract.py covers.tar --output palettes.parquet --workers 16
+    python bulk_extract.py covers.zip --engine kmeans > palettes.jsonl
+
+The source is a directory (walked recursively), a tar archive (optionally
+compressed) or a zip archive. Files and uncompressed tar archives are read
+through mmap, so covers are decoded straight from the page cache, and every
+core extracts in its own process. Each cover gives one record:
+
+    {"path": "covers/a.jpg", "colors": ["#1a2b3c", ...], "width": 640, "height": 640}
+
+or {"path": ..., "error": ...} when it could not be decoded. Records are
+written as they finish, not in source order. A .parquet output writes the
+same fields as columns and needs pyarrow.
+"""
+import argparse
+import json
+import mmap
+import os
+import sys
+import tarfile
+import time
+import zipfile
+from multiprocessing import Pool
+
+from color_spaces import rgb_to_hex
+from palette_engines import DEFAULT_ENGINE, ENGINES, decode_image, extract_palette
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp')
+# Records buffered per Parquet row group
+PARQUET_ROW_GROUP = 10000
+
+# Archives a worker has opened, kept for the covers that follow
+_archives = {}
+
+
+def is_image(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def is_compressed(path):
+    with open(path, 'rb') as archive:
+        magic = archive.read(6)
+    return magic.startswith((b'\x1f\x8b', b'BZh', b'\xfd7zXZ'))
+
+
+def list_covers(source):
+    """Yields one task per cover: ('file', path), ('zip', archive, member),
+    ('tar', archive, member, offset, size) or ('bytes', member, data)"""
+    if os.path.isdir(source):
+        for directory, subdirectories, files in os.walk(source):
+            subdirectories.sort()
+            for name in sorted(files):
+                if is_image(name):
+                    yield 'file', os.path.join(directory, name)
+
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for member in archive.infolist():
+                if not member.is_dir() and is_image(member.filename):
+                    yield 'zip', source, member.filename
+
+    elif tarfile.is_tarfile(source):
+        compressed = is_compressed(source)
+        with tarfile.open(source) as archive:
+            for member in archive:
+                if not member.isfile() or not is_image(member.name):
+                    continue
+                if compressed:
+                    # a compressed stream has no random access, ship the bytes instead
+                    yield 'bytes', member.name, archive.extractfile(member).read()
+                else:
+                    yield 'tar', source, member.name, member.offset_data, member.size
+
+    else:
+        raise ValueError(f"{source} is not a directory, tar or zip archive")
+
+
+def _archive(kind, path):
+    archive = _archives.get(path)
+    if archive is None:
+        if kind == 'zip':
+            archive = zipfile.ZipFile(path)
+        else:
+            with open(path, 'rb') as file:
+                archive = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        _archives[path] = archive
+    return archive
+
+
+def _palette(data, color_count, quality, engine):
+    image, original_size = decode_image(data)
+    palette = extract_palette(image, color_count=color_count, quality=quality,
+                              original_size=original_size, engine=engine)
+    return {
+        "colors": rgb_to_hex(palette),
+        "width": original_size[0],
+        "height": original_size[1],
+    }
+
+
+def extract_task(task, color_count=5, quality=10, engine=DEFAULT_ENGINE):
+    """Palette record of one cover task, runs inside a worker"""
+    kind = task[0]
+    name = task[2] if kind in ('zip', 'tar') else task[1]
+    try:
+        if kind == 'file':
+            with open(task[1], 'rb') as file:
+                if os.fstat(file.fileno()).st_size == 0:
+                    raise ValueError("empty file")
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    return {"path": name, **_palette(data, color_count, quality, engine)}
+        if kind == 'zip':
+            data = _archive(kind, task[1]).read(name)
+        elif kind == 'tar':
+            offset, size = task[3], task[4]
+            data = _archive(kind, task[1])[offset:offset + size]
+        else:
+            data = task[2]
+        return {"path": name, **_palette(data, color_count, quality, engine)}
+    except Exception as e:
+        return {"path": name, "error": str(e) or type(e).__name__}
+
+
+def _extract_star(arguments):
+    return extract_task(*arguments)
+
+
+class JSONLWriter:
+    def __init__(self, path):
+        self.file = sys.stdout if path in (None, '-') else open(path, 'w', encoding='utf-8')
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + '\n')
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+        else:
+            self.file.flush()
+
+
+class ParquetWriter:
+    """Writes records as columns, buffered into row groups"""
+
+    def __init__(self, path):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit("Parquet output needs pyarrow: pip install pyarrow")
+
+        self.pa = pyarrow
+        self.schema = pyarrow.schema([
+            ('path', pyarrow.string()),
+            ('colors', pyarrow.list_(pyarrow.string())),
+            ('width', pyarrow.int32()),
+            ('height', pyarrow.int32()),
+            ('error', pyarrow.string()),
+        ])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        self.rows = []
+
+    def write(self, record):
+        self.rows.append(record)
+        if len(self.rows) >= PARQUET_ROW_GROUP:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            columns = {name: [row.get(name) for row in self.rows] for name in self.schema.names}
+            self.writer.write_table(self.pa.table(columns, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def open_writer(path, output_format=None):
+    if output_format is None:
+        output_format = 'parquet' if path and path.endswith('.parquet') else 'jsonl'
+    return ParquetWriter(path) if output_format == 'parquet' else JSONLWriter(path)
+
+
+def bulk_extract(source, writer, workers=None, color_count=5, quality=10, engine=DEFAULT_ENGINE,
+                 chunksize=16, report_every=10.0):
+    """Extracts every cover under `source` into `writer`, returns (extracted, failed)"""
+    extracted = failed = 0
+    start = last_report = time.perf_counter()
+    tasks = ((task, color_count, quality, engine) for task in list_covers(source))
+
+    with Pool(workers or os.cpu_count()) as pool:
+        for record in pool.imap_unordered(_extract_star, tasks, chunksize=chunksize):
+            writer.write(record)
+            if 'error' in record:
+                failed += 1
+            else:
+                extracted += 1
+
+            now = time.perf_counter()
+            if now - last_report >= report_every:
+                last_report = now
+                done = extracted + failed
+                print(f"{done} covers ({failed} failed) {done / (now - start):.1f}/s",
+                      file=sys.stderr, flush=True)
+
+    elapsed = time.perf_counter() - start
+    done = extracted + failed
+    print(f"done: {done} covers ({failed} failed) in {elapsed:.1f}s, "
+          f"{done / elapsed if elapsed else 0.0:.1f}/s", file=sys.stderr, flush=True)
+    return extracted, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('source', help='directory, tar or zip archive of cover images')
+    parser.add_argument('--output', help='.jsonl or .parquet file, JSONL on stdout by default')
+    parser.add_argument('--format', choices=['jsonl', 'parquet'], help='defaults to the output extension')
+    parser.add_argument('--workers', type=int, help='processes, defaults to the CPU count')
+    parser.add_argument('--engine', default=DEFAULT_ENGINE, choices=sorted(ENGINES))
+    parser.add_argument('--colors', type=int, default=5, help='colors per palette')
+    parser.add_argument('--quality', type=int, default=10, help='pixel sampling step, 1 samples every pixel')
+    parser.add_argument('--chunksize', type=int, default=16, help='covers handed to a worker at a time')
+    args = parser.parse_args()
+
+    writer = open_writer(args.output, args.format)
+    try:
+        extracted, failed = bulk_extract(args.source, writer, args.workers, args.colors,
+                                         args.quality, args.engine, args.chunksize)
+    finally:
+        writer.close()
+    sys.exit(1 if failed and not extracted else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+import threading
+
+import numpy as np
+
+from color_spaces import hex_to_rgb, rgb_to_lab
+
+# Bits per axis of a packed grid cell, Lab axes span at most 256 units
+_CELL_BITS = 8
+
+
+class ColorIndex:
+    """Nearest-palette search over palettes in CIELAB.
+
+    A palette's distance to a query is the mean, over the query colors, of
+    the distance to the palette's closest color, so "#1F1A3F, #CD904D" finds
+    covers that contain both colors whatever else they contain. Every
+    palette color sits in a uniform grid of `cell_size` Lab units, stored as
+    a sorted array of cell IDs. A query only scores the palettes that have a
+    color in the cells around the query colors, and widens that neighborhood
+    until nothing outside it could still beat the k-th result. Palettes
+    added since the grid was last built are scored brute force until enough
+    of them pile up to rebuild it. Queries score a snapshot of the arrays
+    taken under the lock, so they never hold up add().
+    """
+
+    def __init__(self, colors_per_entry=5, cell_size=8.0, rebuild_fraction=0.1, min_rebuild=1024):
+        self.colors_per_entry = colors_per_entry
+        self.cell_size = cell_size
+        self.rebuild_fraction = rebuild_fraction
+        self.min_rebuild = min_rebuild
+
+        self._lock = threading.Lock()
+        self._rows = {}
+        self._keys = []
+        # palettes as uint8 RGB plus their length, far smaller than lists of strings
+        self._rgb = np.empty((1024, colors_per_entry, 3), dtype=np.uint8)
+        self._sizes = np.zeros(1024, dtype=np.uint8)
+        self._labs = np.empty((1024, colors_per_entry, 3), dtype=np.float32)
+        self._alive = np.zeros(1024, dtype=bool)
+
+        # Grid over rows below _indexed
+        self._indexed = 0
+        self._cells = np.empty(0, dtype=np.int64)
+        self._cell_rows = np.empty(0, dtype=np.int64)
+
+        self.queries = 0
+        self.scored = 0
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add(self, key, hex_colors):
+        """Index or replace the palette stored under key"""
+        self.add_many([(key, hex_colors)])
+
+    def add_many(self, palettes):
+        palettes = [(key, list(colors)) for key, colors in palettes if colors]
+        if not palettes:
+            return
+        # short palettes repeat their first color, which leaves every minimum unchanged
+        per_entry = self.colors_per_entry
+        padded = [color for _, colors in palettes
+                  for color in (colors[:per_entry] + [colors[0]] * (per_entry - len(colors)))]
+        rgb = hex_to_rgb(padded).reshape(-1, per_entry, 3)
+        labs = rgb_to_lab(rgb).astype(np.float32)
+
+        with self._lock:
+            start = len(self._keys)
+            self._reserve(start + len(palettes))
+            self._rgb[start:start + len(palettes)] = rgb
+            self._sizes[start:start + len(palettes)] = [min(len(colors), per_entry) for _, colors in palettes]
+            self._labs[start:start + len(palettes)] = labs
+            self._alive[start:start + len(palettes)] = True
+            for row, (key, colors) in enumerate(palettes, start):
+                previous = self._rows.get(key)
+                if previous is not None:
+                    self._alive[previous] = False
+                self._rows[key] = row
+                self._keys.append(key)
+
+            pending = len(self._keys) - self._indexed
+            if pending >= max(self.min_rebuild, self.rebuild_fraction * self._indexed):
+                self._rebuild()
+
+    def query(self, hex_colors, k=10):
+        """The k closest palettes as [(key, distance, colors)], closest first"""
+        query = rgb_to_lab(hex_to_rgb(hex_colors)).astype(np.float32)
+        if not len(query):
+            return []
+
+        # add() only appends keys, writes rows past `total` and swaps in new arrays
+        # when it grows or rebuilds the grid, so only the alive flags it clears need a copy
+        with self._lock:
+            self.queries += 1
+            total = len(self._keys)
+            keys = self._keys
+            rgb, sizes = self._rgb, self._sizes
+            labs = self._labs[:total]
+            alive = self._alive[:total].copy()
+            grid = (self._indexed, self._cells, self._cell_rows)
+        k = min(k, int(alive.sum()))
+        if k == 0:
+            return []
+
+        radius = 0
+        while True:
+            if radius * self.cell_size >= 256:
+                rows = np.flatnonzero(alive)
+                distances = self._distances(labs[rows], query)
+                break
+
+            lower, outside = self._lower_bounds(query, radius, alive, grid)
+            # palettes near every query color first, they set the bar the others must beat
+            rows = np.flatnonzero(lower <= 1e-3)
+            if len(rows) >= k:
+                distances = self._distances(labs[rows], query)
+                bar = np.partition(distances, k - 1)[k - 1]
+                # anything near none of the query colors is at least `outside` away
+                if bar <= outside:
+                    others = np.flatnonzero((lower > 1e-3) & (lower < bar))
+                    rows, distances = self._score_below(rows, distances, others, lower, labs, query, k)
+                    break
+            radius = 1 if radius == 0 else radius * 2
+        with self._lock:
+            self.scored += len(rows)
+
+        order = np.argsort(distances, kind='stable')[:k]
+        return [(keys[rows[i]], float(distances[i]), self._hex_colors(rgb, sizes, rows[i])) for i in order]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._rows),
+                'indexed': self._indexed,
+                'pending': len(self._keys) - self._indexed,
+                'queries': self.queries,
+                'scored': self.scored,
+            }
+
+    @staticmethod
+    def _hex_colors(rgb, sizes, row):
+        return ['#%02x%02x%02x' % tuple(color) for color in rgb[row, :sizes[row]]]
+
+    def _reserve(self, size):
+        if size <= len(self._labs):
+            return
+        capacity = max(size, 2 * len(self._labs))
+        used = len(self._keys)
+        for name in ('_rgb', '_sizes', '_labs', '_alive'):
+            current = getattr(self, name)
+            grown = np.zeros((capacity,) + current.shape[1:], dtype=current.dtype)
+            grown[:used] = current[:used]
+            setattr(self, name, grown)
+
+    def _cell_ids(self, cells):
+        # L spans 0..100 and a, b about -128..128, shifted to non-negative cell numbers
+        cells = cells.astype(np.int64)
+        return (cells[..., 0] << (2 * _CELL_BITS)) | (cells[..., 1] << _CELL_BITS) | cells[..., 2]
+
+    def _cells_of(self, lab):
+        offset = np.array([0, 128, 128], dtype=np.float32)
+        limit = (256 // self.cell_size) + 1
+        return np.clip(np.floor((lab + offset) / self.cell_size), 0, limit)
+
+    def _rebuild(self):
+        total = len(self._keys)
+        rows = np.flatnonzero(self._alive[:total])
+        cells = self._cell_ids(self._cells_of(self._labs[rows]))
+        cell_rows = np.repeat(rows, self.colors_per_entry)
+        cells = cells.reshape(-1)
+        order = np.argsort(cells, kind='stable')
+        self._cells = cells[order]
+        self._cell_rows = cell_rows[order]
+        self._indexed = total
+
+    def _score_below(self, rows, distances, others, lower, labs, query, k, block=16384):
+        """Adds `others` to the scored rows in order of their lower bound, until the k-th best is below it"""
+        others = others[np.argsort(lower[others], kind='stable')]
+        for start in range(0, len(others), block):
+            bar = np.partition(distances, k - 1)[k - 1]
+            chunk = others[start:start + block]
+            chunk = chunk[lower[chunk] < bar]
+            if not len(chunk):
+                break
+            rows = np.concatenate([rows, chunk])
+            distances = np.concatenate([distances, self._distances(labs[chunk], query)])
+        return rows, distances
+
+    def _lower_bounds(self, query, radius, alive, grid):
+        """Lower bound of every row's distance from the grid cells within `radius` of each query color.
+
+        `grid` is the (indexed, cells, cell_rows) snapshot the query took.
+        Returns the bounds and the bound of a row near none of the query
+        colors. Rows added since the last rebuild are not in the grid and get 0.
+        """
+        indexed, grid_cells, grid_rows = grid
+        offset = np.array([0, 128, 128], dtype=np.float32)
+        limit = (256 // self.cell_size) + 1
+        cells = self._cells_of(query)
+
+        # distance from each query color to the faces of its neighborhood, sides at the grid edge never end
+        low = np.where(cells - radius <= 0, np.inf, query + offset - (cells - radius) * self.cell_size)
+        high = np.where(cells + radius >= limit, np.inf, (cells + radius + 1) * self.cell_size - query - offset)
+        covered = np.minimum(np.minimum(low, high).min(axis=1), 1000.0) / len(query)
+
+        outside = covered.sum()
+        lower = np.full(len(alive), outside, dtype=np.float32)
+        steps = np.arange(-radius, radius + 1)
+        offsets = np.stack(np.meshgrid(steps, steps, steps, indexing='ij'), axis=-1).reshape(-1, 3)
+        for cell, share in zip(cells, covered):
+            ids = self._cell_ids(np.clip(cell + offsets, 0, limit))
+            starts = np.searchsorted(grid_cells, ids, side='left')
+            lengths = np.searchsorted(grid_cells, ids, side='right') - starts
+            # concatenate the ranges [start, start + length) without a Python loop
+            positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+            # fancy indexing applies a repeated row once, as it should
+            lower[grid_rows[positions]] -= share
+
+        lower[indexed:] = 0
+        lower[~alive] = np.inf
+        return lower, outside
+
+    @staticmethod
+    def _distances(labs, query):
+        """Mean over query colors of the distance to each palette's closest color"""
+        lightness, green_red, blue_yellow = labs[..., 0], labs[..., 1], labs[..., 2]
+        total = np.zeros(len(labs), dtype=np.float32)
+        for color in query:
+            squared = np.square(lightness - color[0])
+            squared += np.square(green_red - color[1])
+            squared += np.square(blue_yellow - color[2])
+            total += np.sqrt(squared.min(axis=1))
+        return total / len(query)
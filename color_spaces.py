@@ -0,0 +1,93 @@
+import re
+
+import numpy as np
+
+# sRGB (D65) to CIE XYZ
+_RGB_TO_XYZ = np.array([
+    [0.4124564, 0.3575761, 0.1804375],
+    [0.2126729, 0.7151522, 0.0721750],
+    [0.0193339, 0.1191920, 0.9503041],
+])
+_WHITE_D65 = np.array([0.95047, 1.0, 1.08883])
+
+_HEX_COLOR = re.compile(r'^#?[0-9a-fA-F]{6}$')
+
+
+def rgb_to_hex(rgb):
+    """Hex codes of an (N, 3) array of 0-255 sRGB values, channels in r, g, b order
+
+    Channels outside 0-255 are clipped rather than spilling into their neighbours.
+
+    >>> rgb_to_hex([(0x12, 0x34, 0x56), (255, 0, 128)])
+    ['#123456', '#ff0080']
+    >>> rgb_to_hex([(60, 4, 256), (256, 4, -1)])
+    ['#3c04ff', '#ff0400']
+    """
+    rgb = np.clip(np.asarray(rgb, dtype=np.int64).reshape(-1, 3), 0, 255)
+    packed = (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]
+    return [f"#{value:06x}" for value in packed.tolist()]
+
+
+def is_hex_color(color):
+    """Whether color is a '#rrggbb' string hex_to_rgb accepts
+
+    >>> is_hex_color('#3c04ff'), is_hex_color('#1000404'), is_hex_color(None)
+    (True, False, False)
+    """
+    return isinstance(color, str) and bool(_HEX_COLOR.match(color))
+
+
+def hex_to_rgb(hex_colors):
+    """(N, 3) uint8 array of '#rrggbb' strings, raises ValueError on anything else
+
+    >>> hex_to_rgb(['#123456', 'FF0080']).tolist()
+    [[18, 52, 86], [255, 0, 128]]
+    """
+    values = []
+    for color in hex_colors:
+        if not is_hex_color(color):
+            raise ValueError(f"Not a hex color: {color}")
+        values.append(int(color[-6:], 16))
+    values = np.array(values, dtype=np.int64)
+    return np.stack([values >> 16, (values >> 8) & 0xff, values & 0xff], axis=-1).astype(np.uint8)
+
+
+def rgb_to_hsl(rgb):
+    """Convert an (..., 3) array of 0-255 sRGB values to HSL: hue in degrees, saturation and lightness in percent
+
+    >>> rgb_to_hsl([(255, 0, 0), (0, 0, 255), (128, 128, 128)]).round(1).tolist()
+    [[0.0, 100.0, 50.0], [240.0, 100.0, 50.0], [0.0, 0.0, 50.2]]
+    """
+    rgb = np.asarray(rgb, dtype=np.float64) / 255.0
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    high = rgb.max(axis=-1)
+    low = rgb.min(axis=-1)
+    chroma = high - low
+    lightness = (high + low) / 2
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        saturation = np.where(chroma == 0, 0.0, chroma / (1 - np.abs(2 * lightness - 1)))
+        hue = np.select(
+            [chroma == 0, high == r, high == g],
+            [0.0, ((g - b) / chroma) % 6, (b - r) / chroma + 2],
+            (r - g) / chroma + 4,
+        ) * 60
+
+    return np.stack([hue, saturation * 100, lightness * 100], axis=-1)
+
+
+def rgb_to_lab(rgb):
+    """Convert an (..., 3) array of 0-255 sRGB values to CIELAB (D65)"""
+    srgb = np.asarray(rgb, dtype=np.float64) / 255.0
+    linear = np.where(srgb <= 0.04045, srgb / 12.92, ((srgb + 0.055) / 1.055) ** 2.4)
+    xyz = linear @ _RGB_TO_XYZ.T / _WHITE_D65
+
+    epsilon = 216 / 24389
+    kappa = 24389 / 27
+    f = np.where(xyz > epsilon, np.cbrt(xyz), (kappa * xyz + 16) / 116)
+
+    lab = np.empty_like(f)
+    lab[..., 0] = 116 * f[..., 1] - 16
+    lab[..., 1] = 500 * (f[..., 0] - f[..., 1])
+    lab[..., 2] = 200 * (f[..., 1] - f[..., 2])
+    return lab
@@ -0,0 +1,482 @@
+import asyncio
+import collections
+import contextvars
+import heapq
+import itertools
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+
+
+def load_settings():
+    """Read the client and governor settings from the environment, on import and again from create_app().
+
+    Connection pools and governors that already exist keep the settings they were built with.
+    """
+    global POOL_SIZE, POOL_HOSTS, CONNECT_TIMEOUT, READ_TIMEOUT, MAX_RETRIES, BACKOFF_FACTOR
+    global RATE_LIMIT, RATE_BURST, MAX_CONCURRENCY, MAX_WAIT
+    # Defaults can be tuned per deployment through the environment
+    POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '32'))
+    POOL_HOSTS = int(os.getenv('HTTP_POOL_HOSTS', '10'))
+    CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '3.05'))
+    READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '10'))
+    MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', '3'))
+    BACKOFF_FACTOR = float(os.getenv('HTTP_BACKOFF_FACTOR', '0.3'))
+
+    # Calls per second each governed credential may make, 0 for no fixed limit: the rate is then
+    # only capped after a 429, at what got through, and the cap is raised again while no 429s come
+    RATE_LIMIT = float(os.getenv('SPOTIFY_RATE_LIMIT', '0'))
+    # Calls a credential may make at once after being idle, defaults to one second's worth
+    RATE_BURST = float(os.getenv('SPOTIFY_RATE_BURST', '0'))
+    # Most calls in flight per credential, the adaptive concurrency limit never goes above it
+    MAX_CONCURRENCY = int(os.getenv('SPOTIFY_MAX_CONCURRENCY', '32'))
+    # Seconds a call waits for its turn before failing with RateLimited
+    MAX_WAIT = float(os.getenv('SPOTIFY_MAX_WAIT', '5'))
+
+
+load_settings()
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# A 429 cuts the rate and concurrency limits to this share of what was in use
+DECREASE = 0.8
+# Share of the cut rate given back per second without a 429 (at least one call per second),
+# so the rate that drew the 429 comes back after 10 s; the concurrency limit grows one call per second
+RECOVERY = 0.02
+
+# Priorities of governed calls, lower goes first
+INTERACTIVE, BATCH, BACKGROUND = 0, 1, 2
+# Share of the concurrency limit each priority may fill, so interactive calls always find a free slot
+SHARES = (1.0, 0.75, 0.5)
+
+_lock = threading.Lock()
+_local = threading.local()
+# Shared adapters, one that retries and one for callers that retry within a deadline of their own
+_adapters = {}
+_generation = 0
+
+# credential -> Governor, and (URL prefix, credential) for the calls each one governs
+_governors = {}
+_governed = []
+_priority = contextvars.ContextVar('upstream_priority', default=INTERACTIVE)
+
+
+def configure(pool_size=None, pool_hosts=None, connect_timeout=None, read_timeout=None,
+              max_retries=None, backoff_factor=None):
+    """Change the shared client settings; sessions pick them up on next use"""
+    global POOL_SIZE, POOL_HOSTS, CONNECT_TIMEOUT, READ_TIMEOUT, MAX_RETRIES, BACKOFF_FACTOR
+    global _adapters, _generation
+
+    with _lock:
+        if pool_size is not None:
+            POOL_SIZE = pool_size
+        if pool_hosts is not None:
+            POOL_HOSTS = pool_hosts
+        if connect_timeout is not None:
+            CONNECT_TIMEOUT = connect_timeout
+        if read_timeout is not None:
+            READ_TIMEOUT = read_timeout
+        if max_retries is not None:
+            MAX_RETRIES = max_retries
+        if backoff_factor is not None:
+            BACKOFF_FACTOR = backoff_factor
+
+        old_adapters = _adapters
+        _adapters = {}
+        _generation += 1
+
+    for old_adapter in old_adapters.values():
+        old_adapter.close()
+
+
+def _build_adapter(retries):
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset({'GET', 'HEAD', 'POST'}),
+        respect_retry_after_header=True,
+        # hand the last response back instead of raising, callers check status codes
+        raise_on_status=False,
+    )
+    return HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_SIZE, max_retries=retry)
+
+
+def _shared_adapter(retry):
+    with _lock:
+        adapter = _adapters.get(retry)
+        if adapter is None:
+            adapter = _adapters[retry] = _build_adapter(MAX_RETRIES if retry else 0)
+        return adapter, _generation
+
+
+def session(retry=True):
+    """Return this thread's Session.
+
+    Sessions are per thread (they carry cookies and are not thread-safe), but
+    they all mount the same adapter, so connections to a host are pooled and
+    kept alive across every thread in the process. With retry=False the
+    session answers the first response or error as is, for callers that
+    retry on their own.
+    """
+    sessions = getattr(_local, 'sessions', None)
+    if sessions is None or _local.generation != _generation:
+        sessions = _local.sessions = {}
+        _local.generation = _generation
+
+    current = sessions.get(retry)
+    if current is not None:
+        return current
+
+    adapter, generation = _shared_adapter(retry)
+    current = requests.Session()
+    current.mount('https://', adapter)
+    current.mount('http://', adapter)
+    if generation == _local.generation:
+        sessions[retry] = current
+    return current
+
+
+def retry_delay(response, attempt):
+    """Seconds to wait before retrying after `response`, honoring Retry-After"""
+    retry_after = response.headers.get('Retry-After')
+    if retry_after is not None and retry_after.isdigit():
+        return int(retry_after)
+    return BACKOFF_FACTOR * (2 ** attempt)
+
+
+class RateLimited(Exception):
+    """A governed call could not be sent within MAX_WAIT, retry_after is when to try again"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"rate limited, try again in {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class priority:
+    """Sets the priority of the governed calls made in a block: `with http_client.priority(BATCH): ...`"""
+
+    __slots__ = ('level', 'token')
+
+    def __init__(self, level):
+        self.level = level
+
+    def __enter__(self):
+        self.token = _priority.set(self.level)
+        return self
+
+    def __exit__(self, *exc_info):
+        _priority.reset(self.token)
+
+
+def current_priority():
+    """The priority governed calls get here, for handing it on to other threads"""
+    return _priority.get()
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class Governor:
+    """Admits the calls made with one credential, keeping them under its rate limit.
+
+    A token bucket holds calls to `rate` per second, and at most `limit`
+    are in flight. Both adapt (AIMD): a 429 cuts them to DECREASE of the
+    rate that got through in the last second and of the calls in flight,
+    once per round of calls, and they grow back linearly while no more 429s
+    come, so they settle just under Spotify's quota instead of bursting into
+    it again. A 429's Retry-After pauses every call, not just the one that
+    got it. Waiting calls queue by priority, then arrival, and lower
+    priorities may only fill part of the limit (SHARES). Threads and asyncio
+    tasks wait in the same queue; a call that would wait past max_wait
+    raises RateLimited instead.
+    """
+
+    def __init__(self, rate=None, burst=None, max_concurrency=None, max_wait=None):
+        self.max_rate = (RATE_LIMIT if rate is None else rate) or float('inf')
+        self.rate = self.max_rate
+        self.burst = RATE_BURST if burst is None else burst
+        self.max_concurrency = MAX_CONCURRENCY if max_concurrency is None else max_concurrency
+        self.max_wait = MAX_WAIT if max_wait is None else max_wait
+
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._async_waiters = []
+        # (priority, arrival) of every waiting call, the first one is next
+        self._queue = []
+        self._arrivals = itertools.count()
+        # admission times of the last second, to know the rate a 429 answered
+        self._recent = collections.deque()
+        self._tokens = self._capacity()
+        self._refilled = time.monotonic()
+        self._decreased = 0.0
+        self._recovered = 0.0
+        # growth per second of the rate and the concurrency limit since the last cut
+        self._rate_step = 0.0
+        self._limit_step = 0.0
+
+        self.limit = float(self.max_concurrency)
+        self.in_flight = 0
+        self.paused_until = 0.0
+
+        self.admitted = 0
+        self.throttled = 0
+        self.rejected = 0
+
+    def acquire(self, level=None):
+        """Waits for a slot for one call, raises RateLimited"""
+        ticket = self._enqueue(level)
+        start = time.monotonic()
+        with self._lock:
+            try:
+                while True:
+                    wait = self._next(ticket, start + self.max_wait)
+                    if wait == 0:
+                        break
+                    self._changed.wait(wait)
+            except BaseException:
+                self._dequeue(ticket)
+                raise
+        self._record_wait(start)
+
+    async def acquire_async(self, level=None):
+        """acquire() for asyncio, the event loop keeps running while the call waits"""
+        ticket = self._enqueue(level)
+        start = time.monotonic()
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                with self._lock:
+                    wait = self._next(ticket, start + self.max_wait)
+                    if wait == 0:
+                        break
+                    woken = loop.create_future()
+                    self._async_waiters.append((loop, woken))
+                await asyncio.wait([woken], timeout=wait)
+        except BaseException:
+            with self._lock:
+                self._dequeue(ticket)
+            raise
+        self._record_wait(start)
+
+    def release(self, started, status, retry_after=None):
+        """Frees the slot of a call sent at `started` (monotonic), status is None when no answer came"""
+        now = time.monotonic()
+        with self._lock:
+            in_flight = self.in_flight
+            self.in_flight -= 1
+            if status == 429:
+                self.throttled += 1
+                self.paused_until = max(self.paused_until, now + (retry_after or BACKOFF_FACTOR))
+                # calls sent before the last cut were refused for the old limits, do not cut again
+                if started >= self._decreased:
+                    self._trim(now)
+                    self.rate = max(1.0, DECREASE * min(self.rate, len(self._recent)))
+                    self.limit = max(1.0, DECREASE * min(self.limit, in_flight))
+                    self._rate_step = max(1.0, RECOVERY * self.rate)
+                    self._limit_step = 1.0
+                    self._decreased = now
+                    # the bucket refills from the end of the pause, at the new rate
+                    self._tokens = 0.0
+                    self._refilled = self.paused_until
+            self._notify()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'rate': self.rate,
+                'limit': self.limit,
+                'in_flight': self.in_flight,
+                'queued': len(self._queue),
+                'admitted': self.admitted,
+                'throttled': self.throttled,
+                'rejected': self.rejected,
+            }
+
+    def _capacity(self):
+        return self.burst or max(self.rate, 1.0)
+
+    def _trim(self, now):
+        while self._recent and self._recent[0] <= now - 1:
+            self._recent.popleft()
+
+    def _recover(self, now):
+        # linear growth back towards the ceilings, counted from the end of the last pause
+        elapsed = now - max(self._recovered, self.paused_until)
+        if elapsed > 0:
+            self._recovered = now
+            self.rate = min(self.max_rate, self.rate + self._rate_step * elapsed)
+            self.limit = min(float(self.max_concurrency), self.limit + self._limit_step * elapsed)
+
+    def _enqueue(self, level):
+        ticket = (current_priority() if level is None else level, next(self._arrivals))
+        with self._lock:
+            heapq.heappush(self._queue, ticket)
+        return ticket
+
+    def _dequeue(self, ticket):
+        # under the lock, for a call that gave up
+        if ticket in self._queue:
+            self._queue.remove(ticket)
+            heapq.heapify(self._queue)
+        self._notify()
+
+    def _next(self, ticket, deadline):
+        """Admits ticket, or returns the seconds to wait before trying again; under the lock"""
+        now = time.monotonic()
+        delay = self._admit(ticket, now)
+        if delay == 0:
+            return 0
+        if delay is None:
+            # waiting on other calls, they wake us when they finish
+            if now >= deadline:
+                self.rejected += 1
+                raise RateLimited(1.0)
+            return deadline - now
+        if now + delay > deadline:
+            self.rejected += 1
+            raise RateLimited(delay)
+        return delay
+
+    def _admit(self, ticket, now):
+        # 0 when admitted, else seconds until it could be, None when that depends on other calls
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self._queue[0] != ticket:
+            return None
+        self._recover(now)
+        if self.in_flight >= max(1.0, self.limit * SHARES[min(ticket[0], len(SHARES) - 1)]):
+            return None
+        if self.rate != float('inf'):
+            self._tokens = min(self._capacity(), self._tokens + (now - self._refilled) * self.rate)
+            self._refilled = now
+            if self._tokens < 1:
+                return (1 - self._tokens) / self.rate
+            self._tokens -= 1
+
+        heapq.heappop(self._queue)
+        self.in_flight += 1
+        self.admitted += 1
+        self._recent.append(now)
+        self._trim(now)
+        # the next in line may fit too
+        self._notify()
+        return 0
+
+    def _notify(self):
+        self._changed.notify_all()
+        for loop, woken in self._async_waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, woken)
+            except RuntimeError:
+                # that loop is closed, nobody is waiting there any more
+                pass
+        self._async_waiters = []
+
+    def _record_wait(self, start):
+        waited = time.monotonic() - start
+        if waited > 0.001:
+            metrics.record('upstream_queue', waited)
+
+
+def govern(prefix, credential):
+    """Sends every call to a URL under prefix through the Governor of credential"""
+    with _lock:
+        if credential not in _governors:
+            _governors[credential] = Governor()
+        if (prefix, credential) not in _governed:
+            _governed.append((prefix, credential))
+
+
+def governor_for(url):
+    """The Governor of url, None for calls that are not governed"""
+    for prefix, credential in _governed:
+        if url.startswith(prefix):
+            return _governors[credential]
+    return None
+
+
+def _governed_request(governor, method, url, retry, **kwargs):
+    # one slot per attempt, and 429 and 5xx are retried here rather than by urllib3,
+    # so every answer reaches the governor and a Retry-After pauses the other calls too
+    attempts = MAX_RETRIES + 1 if retry else 1
+    for attempt in range(attempts):
+        governor.acquire()
+        started = time.monotonic()
+        try:
+            response = _send(method, url, False, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            governor.release(started, None)
+            if attempt == attempts - 1:
+                raise
+            time.sleep(BACKOFF_FACTOR * (2 ** attempt))
+            continue
+        except BaseException:
+            governor.release(started, None)
+            raise
+
+        status = response.status_code
+        governor.release(started, status, retry_delay(response, attempt) if status == 429 else None)
+        if status not in RETRY_STATUSES or attempt == attempts - 1:
+            return response
+        # after a 429 the governor holds the next attempt back until Retry-After
+        if status != 429:
+            time.sleep(retry_delay(response, attempt))
+    return response
+
+
+def request(method, url, retry=True, **kwargs):
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    governor = governor_for(url)
+    if governor is not None:
+        return _governed_request(governor, method, url, retry, **kwargs)
+    return _send(method, url, retry, **kwargs)
+
+
+def _send(method, url, retry, **kwargs):
+    try:
+        response = session(retry).request(method, url, **kwargs)
+    except requests.RequestException:
+        metrics.UPSTREAM.inc(urlsplit(url).hostname or '', 'error')
+        raise
+    metrics.UPSTREAM.inc(urlsplit(url).hostname or '', str(response.status_code))
+    return response
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+@metrics.collector
+def governor_metrics():
+    with _lock:
+        governors = sorted(_governors.items())
+    stats = [({'credential': credential}, governor.stats()) for credential, governor in governors]
+    return [
+        ('palette_upstream_concurrency_limit', 'gauge', 'Adaptive limit of concurrent calls per credential',
+         [(labels, round(values['limit'], 2)) for labels, values in stats]),
+        ('palette_upstream_in_flight', 'gauge', 'Governed calls in flight per credential',
+         [(labels, values['in_flight']) for labels, values in stats]),
+        ('palette_upstream_queued', 'gauge', 'Governed calls waiting for their turn per credential',
+         [(labels, values['queued']) for labels, values in stats]),
+        ('palette_upstream_governed_total', 'counter',
+         'Governed calls admitted, answered with a 429, or rejected after waiting too long',
+         [(dict(labels, result=result), values[result]) for labels, values in stats
+          for result in ('admitted', 'throttled', 'rejected')]),
+    ]
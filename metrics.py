@@ -0,0 +1,216 @@
+import bisect
+import contextvars
+import os
+import threading
+import time
+
+
+def load_settings():
+    """Read the settings from the environment, on import and again from create_app()"""
+    global SERVER_TIMING
+    # Add a Server-Timing header listing the stages of every response
+    SERVER_TIMING = os.getenv('SERVER_TIMING', '0').lower() in ('1', 'true', 'yes')
+
+
+load_settings()
+
+# Histogram bucket bounds in seconds, about 1.5x apart from 0.5 ms to 28 s
+BUCKETS = tuple(float(f"{0.0005 * 1.5 ** i:.3g}") for i in range(28))
+# Quantiles estimated from the buckets and exposed next to each histogram
+QUANTILES = (0.5, 0.95, 0.99)
+
+_families = []
+_collectors = []
+
+# Stages of the current request for Server-Timing, None when not collecting
+_timings = contextvars.ContextVar('server_timing', default=None)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _sample(name, labels, value):
+    if not labels:
+        return f"{name} {value}"
+    pairs = ','.join(f'{label}="{_escape(label_value)}"' for label, label_value in labels)
+    return f"{name}{{{pairs}}} {value}"
+
+
+class Counter:
+    """Monotonic counts per combination of label values"""
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values = {}
+        _families.append(self)
+
+    def inc(self, *values, amount=1):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def value(self, *values):
+        with self._lock:
+            return self._values.get(values, 0)
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines.extend(_sample(self.name, zip(self.labels, label_values), count)
+                     for label_values, count in values)
+        return lines
+
+
+class Histogram:
+    """Latency histogram per value of one label.
+
+    Recording is a bisect into fixed buckets and two additions under a lock,
+    cheap enough for every request. Rendered as a Prometheus histogram, plus
+    a `<name>_quantile` gauge with p50/p95/p99 interpolated from the buckets
+    for reading them without a Prometheus server.
+    """
+
+    def __init__(self, name, help, label, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # label value -> [per-bucket counts with a last +Inf bucket, sum, smallest and largest observation]
+        self._series = {}
+        _families.append(self)
+
+    def observe(self, value, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(value)
+            if series is None:
+                series = self._series[value] = [[0] * (len(self.buckets) + 1), 0.0, seconds, seconds]
+            series[0][index] += 1
+            series[1] += seconds
+            if seconds < series[2]:
+                series[2] = seconds
+            elif seconds > series[3]:
+                series[3] = seconds
+
+    def quantile(self, value, q):
+        """Estimated q-quantile of one series in seconds, None without observations"""
+        with self._lock:
+            series = self._series.get(value)
+            if series is None:
+                return None
+            counts, _, low, high = list(series[0]), *series[1:]
+        return self._quantile(counts, low, high, q)
+
+    def _quantile(self, counts, low, high, q):
+        # interpolates inside the bucket holding the rank, within the observed range
+        rank = q * sum(counts)
+        seen = 0
+        for index, count in enumerate(counts):
+            if count and seen + count >= rank:
+                lower = max(self.buckets[index - 1] if index else 0.0, low)
+                upper = min(self.buckets[index] if index < len(self.buckets) else high, high)
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return high
+
+    def render(self):
+        with self._lock:
+            series = sorted((value, list(counts), total, low, high)
+                            for value, (counts, total, low, high) in self._series.items())
+
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        quantiles = [f"# HELP {self.name}_quantile {self.help}, estimated from the histogram buckets",
+                     f"# TYPE {self.name}_quantile gauge"]
+        for value, counts, total, low, high in series:
+            label = (self.label, value)
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(_sample(f"{self.name}_bucket", (label, ('le', bound)), cumulative))
+            cumulative += counts[-1]
+            lines.append(_sample(f"{self.name}_bucket", (label, ('le', '+Inf')), cumulative))
+            lines.append(_sample(f"{self.name}_sum", (label,), round(total, 6)))
+            lines.append(_sample(f"{self.name}_count", (label,), cumulative))
+            for q in QUANTILES:
+                quantiles.append(_sample(f"{self.name}_quantile", (label, ('quantile', q)),
+                                         round(self._quantile(counts, low, high, q), 6)))
+        return lines + quantiles
+
+
+def collector(function):
+    """Registers a function called on every scrape.
+
+    It returns [(name, type, help, [(labels, value)])], with labels as a
+    dict. This exposes counts that objects already keep, such as cache hits,
+    without touching them on the hot path.
+    """
+    _collectors.append(function)
+    return function
+
+
+def render():
+    """Every metric in the Prometheus text format"""
+    lines = []
+    for family in _families:
+        lines.extend(family.render())
+    for function in _collectors:
+        for name, kind, help, samples in function():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(_sample(name, labels.items(), value) for labels, value in samples)
+    return '\n'.join(lines) + '\n'
+
+
+STAGES = Histogram('palette_stage_seconds', 'Seconds spent in each stage of handling a request', 'stage')
+REQUESTS = Histogram('palette_request_seconds', 'Seconds until the response headers, per route', 'route')
+RESPONSES = Counter('palette_responses_total', 'Responses per route and status', ('route', 'status'))
+UPSTREAM = Counter('palette_upstream_responses_total',
+                   'Spotify and artwork responses per host and status, "error" when none arrived',
+                   ('host', 'status'))
+FALLBACKS = Counter('palette_fallbacks_total', 'Default palettes served instead of the real one, per cause',
+                    ('reason',))
+
+
+def record(stage, seconds):
+    STAGES.observe(stage, seconds)
+    timings = _timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+class span:
+    """Times a block as one stage: `with metrics.span('spotify_search'): ...`"""
+
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.stage, time.perf_counter() - self.start)
+
+
+def start_request():
+    """Starts collecting the current request's stages, only when SERVER_TIMING is on"""
+    _timings.set({} if SERVER_TIMING else None)
+
+
+def finish_request(route, status, seconds):
+    """Records a finished request, returns its Server-Timing header or None"""
+    REQUESTS.observe(route, seconds)
+    RESPONSES.inc(route, str(status))
+    timings = _timings.get()
+    if timings is None:
+        return None
+    parts = [f"{stage};dur={stage_seconds * 1000:.1f}" for stage, stage_seconds in timings.items()]
+    parts.append(f"total;dur={seconds * 1000:.1f}")
+    return ', '.join(parts)
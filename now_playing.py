@@ -0,0 +1,164 @@
+import os
+import queue
+import threading
+
+
+def load_settings():
+    """Read the polling settings from the environment, on import and again from create_app()"""
+    global INTERVAL, IDLE_INTERVAL, KEEPALIVE
+    # Seconds between polls of a listener's player while a track is playing
+    INTERVAL = float(os.getenv('NOW_PLAYING_INTERVAL', '5'))
+    # Seconds between polls while nothing is playing or playback is paused
+    IDLE_INTERVAL = float(os.getenv('NOW_PLAYING_IDLE_INTERVAL', '20'))
+    # Seconds a stream may stay silent before a keep-alive comment is sent
+    KEEPALIVE = float(os.getenv('NOW_PLAYING_KEEPALIVE', '15'))
+
+
+load_settings()
+
+
+class PlayerWatch:
+    """Polls one listener's player on behalf of every stream subscribed to it.
+
+    `poll(state)` runs on the watch's own thread and returns (events, delay):
+    the (event, payload) pairs to push and the seconds until the next poll,
+    or None as delay to stop. `state` is a dict kept between polls, so the
+    poll function can remember what it already sent. The last event is
+    replayed to late subscribers, and the thread exits once the last one
+    has left.
+    """
+
+    def __init__(self, key, poll, on_stop=None):
+        self.key = key
+        self.poll = poll
+        self.on_stop = on_stop
+
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._wake = threading.Event()
+        self._state = {}
+        self._last = None
+        self._thread = None
+
+        self.polls = 0
+        self.events = 0
+
+    def subscribe(self):
+        """Returns a queue of (event, payload) pairs, None once the watch stops"""
+        subscriber = queue.Queue()
+        with self._lock:
+            self._subscribers.add(subscriber)
+            if self._last is not None:
+                subscriber.put(self._last)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"player-watch-{id(self)}",
+                                                daemon=True)
+                self._thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+            if not self._subscribers:
+                self._wake.set()
+
+    @property
+    def running(self):
+        with self._lock:
+            return self._thread is not None
+
+    @property
+    def subscribers(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def _publish(self, event, payload):
+        with self._lock:
+            self._last = (event, payload)
+            self.events += 1
+            for subscriber in self._subscribers:
+                subscriber.put((event, payload))
+
+    def _run(self):
+        delay = 0
+        while True:
+            with self._lock:
+                if not self._subscribers:
+                    self._thread = None
+                    break
+
+            self.polls += 1
+            try:
+                events, delay = self.poll(self._state)
+            except Exception as e:
+                print(f"Error polling player: {e}")
+                events, delay = [], INTERVAL
+
+            for event, payload in events:
+                self._publish(event, payload)
+            if delay is None:
+                with self._lock:
+                    subscribers, self._subscribers = self._subscribers, set()
+                    self._thread = None
+                for subscriber in subscribers:
+                    subscriber.put(None)
+                break
+
+            # unsubscribe() wakes us early so an abandoned watch exits promptly
+            self._wake.wait(delay)
+            self._wake.clear()
+
+        if self.on_stop is not None:
+            self.on_stop(self)
+
+
+class PlayerWatches:
+    """One PlayerWatch per key, created on first subscribe and dropped when it stops"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._watches = {}
+
+    def subscribe(self, key, poll):
+        """Returns (watch, subscriber queue) for key, starting its poller if needed"""
+        with self._lock:
+            watch = self._watches.get(key)
+            if watch is None:
+                watch = self._watches[key] = PlayerWatch(key, poll, on_stop=self._stopped)
+            subscriber = watch.subscribe()
+        return watch, subscriber
+
+    def _stopped(self, watch):
+        with self._lock:
+            # a subscriber may have restarted it after the old thread gave up
+            if self._watches.get(watch.key) is watch and not watch.running:
+                del self._watches[watch.key]
+
+    def stats(self):
+        with self._lock:
+            watches = list(self._watches.values())
+        return {
+            'watches': len(watches),
+            'subscribers': sum(watch.subscribers for watch in watches),
+            'polls': sum(watch.polls for watch in watches),
+        }
+
+
+def listen(watch, subscriber, keepalive=None):
+    """Yields (event, payload) from a subscriber queue, None after `keepalive` quiet seconds.
+
+    Unsubscribes when the consumer closes the generator, e.g. when the
+    browser goes away and the server stops the response.
+    """
+    try:
+        while True:
+            try:
+                item = subscriber.get(timeout=KEEPALIVE if keepalive is None else keepalive)
+            except queue.Empty:
+                yield None
+                continue
+            if item is None:
+                return
+            yield item
+    finally:
+        watch.unsubscribe(subscriber)
@@ -0,0 +1,199 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+from palette_engines import decode_image, extract_palette, extract_swatches
+
+
+def load_settings():
+    """Read the pool size from the environment, on import and again from create_app()"""
+    global WORKERS, QUEUE_SIZE, QUEUE_TIMEOUT
+    # Worker processes per app process, 0 extracts inline on the request thread
+    WORKERS = int(os.getenv('PALETTE_WORKERS', str(os.cpu_count() or 1)))
+    # Extractions allowed to be running or waiting before new ones are turned away
+    QUEUE_SIZE = int(os.getenv('PALETTE_QUEUE_SIZE', str(max(WORKERS, 1) * 4)))
+    # Seconds a request waits for a queue slot before giving up
+    QUEUE_TIMEOUT = float(os.getenv('PALETTE_QUEUE_TIMEOUT', '2'))
+
+
+load_settings()
+
+
+class PaletteQueueFull(Exception):
+    """Raised when every palette worker is busy and the queue is full"""
+
+
+def extract_from_bytes(data, color_count=5, quality=10, engine=None):
+    """Decode image bytes and extract their [((r, g, b), pixel_count)] swatches, runs inside a worker"""
+    return _timed_extract(data, color_count, quality, engine)[0]
+
+
+def record_stages(decode_seconds, quantize_seconds):
+    """Record a finished extraction's stage times, on the request's own thread or task"""
+    metrics.record('palette_decode', decode_seconds)
+    metrics.record('palette_quantize', quantize_seconds)
+
+
+def _timed_extract(data, color_count, quality, engine):
+    # the worker times its own stages, the caller records them
+    start = time.perf_counter()
+    image, original_size = decode_image(data)
+    decoded = time.perf_counter()
+    swatches = extract_swatches(image, color_count=color_count, quality=quality,
+                                original_size=original_size, engine=engine)
+    return swatches, decoded - start, time.perf_counter() - decoded
+
+
+def _warm_up():
+    # Pay for imports and the first NumPy calls before real work arrives
+    import numpy as np
+    from PIL import Image
+
+    image = Image.fromarray(np.arange(48, dtype=np.uint8).reshape(4, 4, 3))
+    extract_palette(image, color_count=2, quality=1)
+
+
+def _context():
+    # Forking a process that already runs request threads can copy held
+    # locks into the child, start workers from a clean server process instead
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+class PalettePool:
+    """Bounded process pool for CPU-bound palette extraction.
+
+    Only the compressed image bytes cross the process boundary (they pickle
+    as a single buffer copy) and only the small palette comes back. A
+    semaphore caps running plus queued jobs at `queue_size`; callers that
+    cannot get a slot within `queue_timeout` get PaletteQueueFull, which the
+    app turns into a 503 instead of letting requests pile up.
+    """
+
+    def __init__(self, workers=None, queue_size=None, queue_timeout=None):
+        self.workers = WORKERS if workers is None else workers
+        self.queue_size = QUEUE_SIZE if queue_size is None else queue_size
+        self.queue_timeout = QUEUE_TIMEOUT if queue_timeout is None else queue_timeout
+
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max(self.queue_size, 1))
+        self._executor = None
+        self._pid = None
+
+        self.submitted = 0
+        self.rejected = 0
+
+    def start(self):
+        """Start the workers and wait until each one has warmed up"""
+        if self.workers <= 0:
+            return None
+        with self._lock:
+            # a pool started before a fork (e.g. gunicorn --preload) belongs to the parent
+            if self._executor is not None and self._pid != os.getpid():
+                self._executor = None
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=_context(),
+                                                     initializer=_warm_up)
+                self._pid = os.getpid()
+                # one task per worker makes every process start now rather than on first use
+                for future in [self._executor.submit(os.getpid) for _ in range(self.workers)]:
+                    future.result()
+            return self._executor
+
+    def start_in_background(self):
+        """Start the workers on a thread, so the first extraction does not wait for them.
+
+        Not a daemon: a script that exits right away waits for the workers
+        to come up and shuts them down cleanly instead of killing them mid-start.
+        """
+        if self.workers <= 0:
+            return None
+        thread = threading.Thread(target=self._start_quietly, name='palette-pool-start')
+        thread.start()
+        return thread
+
+    def _start_quietly(self):
+        try:
+            self.start()
+        except RuntimeError:
+            # the interpreter began exiting before the workers came up, concurrent.futures
+            # refuses new work from then on; a real failure shows again on the next submit()
+            self.shutdown()
+        except Exception as e:
+            # submit() tries again on the next extraction
+            print(f"Error starting palette workers: {e}")
+
+    def submit(self, data, color_count=5, quality=10, engine=None):
+        """Queue an extraction, returns a concurrent.futures.Future of
+        (swatches, decode_seconds, quantize_seconds).
+
+        Its callbacks run on the executor's management thread, outside the
+        request, so the caller records the stage times with record_stages().
+        """
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            self.rejected += 1
+            raise PaletteQueueFull("Palette extraction queue is full")
+
+        try:
+            executor = self.start()
+            if executor is None:
+                timed = _completed(_timed_extract, data, color_count, quality, engine)
+            else:
+                timed = executor.submit(_timed_extract, data, color_count, quality, engine)
+        except BrokenProcessPool:
+            # a worker died (e.g. OOM killed), start a fresh pool for the next caller
+            self._reset()
+            self._slots.release()
+            raise
+        except BaseException:
+            self._slots.release()
+            raise
+
+        self.submitted += 1
+        timed.add_done_callback(lambda _: self._slots.release())
+        return timed
+
+    def extract(self, data, color_count=5, quality=10, engine=None):
+        future = self.submit(data, color_count, quality, engine)
+        try:
+            swatches, decode_seconds, quantize_seconds = future.result()
+        except BrokenProcessPool:
+            self._reset()
+            raise
+        record_stages(decode_seconds, quantize_seconds)
+        return swatches
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'queue_size': self.queue_size,
+            'submitted': self.submitted,
+            'rejected': self.rejected,
+        }
+
+    def _reset(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _completed(function, *args):
+    # Inline mode still hands back a Future so callers do not need two code paths
+    future = Future()
+    try:
+        future.set_result(function(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
@@ -0,0 +1,228 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse
+
+
+def key_string(key):
+    """Serialize a palette key tuple into a string usable by any backend"""
+    return json.dumps(list(key), separators=(',', ':'))
+
+
+class PaletteStore:
+    """Interface for persistent palette storage shared between processes.
+
+    Backends store palettes as JSON-compatible lists of [hex, pixel_count]
+    pairs, e.g. [['#3c04ff', 812], ['#e89dad', 301]], under a key tuple such
+    as (image_url, color_count, quality, engine), and must hand the same
+    shape back from get() and items(). Lookups return None on a miss and
+    backends should not raise for transient storage errors, a miss is
+    always a safe answer.
+
+    Backends may also keep the album details of covers in the color index,
+    one JSON object per image URL, so /similar can still name them after a
+    restart. The defaults remember nothing.
+    """
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, colors):
+        raise NotImplementedError
+
+    def items(self):
+        """Iterate over every stored (key, colors) pair"""
+        raise NotImplementedError
+
+    def get_album(self, image_url):
+        return None
+
+    def set_album(self, image_url, album):
+        pass
+
+    def close(self):
+        pass
+
+
+class NullPaletteStore(PaletteStore):
+    """Store that remembers nothing, used when persistence is disabled"""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, colors):
+        pass
+
+    def items(self):
+        return iter(())
+
+
+class MemoryPaletteStore(PaletteStore):
+    """Process-local store, mostly useful for tests and one-off scripts"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._palettes = {}
+        self._albums = {}
+
+    def get(self, key):
+        with self._lock:
+            colors = self._palettes.get(key_string(key))
+        return list(colors) if colors is not None else None
+
+    def set(self, key, colors):
+        with self._lock:
+            self._palettes[key_string(key)] = tuple(colors)
+
+    def items(self):
+        with self._lock:
+            palettes = list(self._palettes.items())
+        for key, colors in palettes:
+            yield tuple(json.loads(key)), list(colors)
+
+    def get_album(self, image_url):
+        with self._lock:
+            album = self._albums.get(image_url)
+        return dict(album) if album is not None else None
+
+    def set_album(self, image_url, album):
+        with self._lock:
+            self._albums[image_url] = dict(album)
+
+
+class SQLitePaletteStore(PaletteStore):
+    """Palette store in a local SQLite file, shared by every worker on the host.
+
+    The database runs in WAL mode so readers in other processes never block
+    on a writer, and reads go through SQLite's memory-mapped I/O. Each thread
+    gets its own connection.
+    """
+
+    def __init__(self, path, mmap_size=64 * 1024 * 1024, busy_timeout=5000):
+        self.path = path
+        self.mmap_size = mmap_size
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout / 1000)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+            connection.execute(f'PRAGMA busy_timeout={int(self.busy_timeout)}')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS palettes ('
+                'key TEXT PRIMARY KEY, colors TEXT NOT NULL, updated_at REAL NOT NULL)'
+            )
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS albums ('
+                'image_url TEXT PRIMARY KEY, album TEXT NOT NULL, updated_at REAL NOT NULL)'
+            )
+            connection.commit()
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        try:
+            row = self._connection().execute(
+                'SELECT colors FROM palettes WHERE key = ?', (key_string(key),)
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Error reading palette store: {e}")
+            return None
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, colors):
+        try:
+            connection = self._connection()
+            with connection:
+                connection.execute(
+                    'INSERT OR REPLACE INTO palettes (key, colors, updated_at) VALUES (?, ?, ?)',
+                    (key_string(key), json.dumps(list(colors)), time.time())
+                )
+        except sqlite3.Error as e:
+            print(f"Error writing palette store: {e}")
+
+    def items(self, batch_size=10000):
+        # a connection of its own, so a long scan does not hold this thread's one
+        try:
+            self._connection()  # creates the table on a fresh database
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout / 1000)
+        except sqlite3.Error as e:
+            print(f"Error reading palette store: {e}")
+            return
+        try:
+            cursor = connection.execute('SELECT key, colors FROM palettes')
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for key, colors in rows:
+                    yield tuple(json.loads(key)), json.loads(colors)
+        except sqlite3.Error as e:
+            print(f"Error reading palette store: {e}")
+        finally:
+            connection.close()
+
+    def get_album(self, image_url):
+        try:
+            row = self._connection().execute(
+                'SELECT album FROM albums WHERE image_url = ?', (image_url,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Error reading palette store: {e}")
+            return None
+        return json.loads(row[0]) if row else None
+
+    def set_album(self, image_url, album):
+        try:
+            connection = self._connection()
+            with connection:
+                connection.execute(
+                    'INSERT OR REPLACE INTO albums (image_url, album, updated_at) VALUES (?, ?, ?)',
+                    (image_url, json.dumps(album), time.time())
+                )
+        except sqlite3.Error as e:
+            print(f"Error writing palette store: {e}")
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+
+def _sqlite_backend(url):
+    # sqlite:///relative.db and sqlite:////absolute/path.db, like SQLAlchemy
+    path = url.path[1:] if url.path.startswith('/') else url.path
+    return SQLitePaletteStore(path or 'palettes.db')
+
+
+STORE_BACKENDS = {
+    'none': lambda url: NullPaletteStore(),
+    'memory': lambda url: MemoryPaletteStore(),
+    'sqlite': _sqlite_backend,
+}
+
+
+def register_store_backend(scheme, factory):
+    """Make `scheme://...` URLs open a store built by factory(parsed_url)"""
+    STORE_BACKENDS[scheme] = factory
+
+
+def open_palette_store(url):
+    """Open a palette store from a URL such as sqlite:///palettes.db"""
+    if not url:
+        return NullPaletteStore()
+    parsed = urlparse(url)
+    scheme = parsed.scheme or url
+    if scheme not in STORE_BACKENDS:
+        raise ValueError(f"Unknown palette store backend: {scheme}")
+    return STORE_BACKENDS[scheme](parsed)
@@ -0,0 +1,90 @@
+import asyncio
+import threading
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls that share a key into one.
+
+    The first caller for a key runs the function; callers that arrive while
+    it is running wait and get the same result (or exception) instead of
+    repeating the work. Nothing is remembered once the call finishes, pair
+    it with a cache for that.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, function, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            return {'calls': self.calls, 'coalesced': self.coalesced, 'in_flight': len(self._calls)}
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines running on one event loop"""
+
+    def __init__(self):
+        self._calls = {}
+
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key, function, *args, **kwargs):
+        future = self._calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+            # shield so one cancelled waiter does not cancel the shared call
+            return await asyncio.shield(future)
+
+        self.calls += 1
+        future = asyncio.ensure_future(function(*args, **kwargs))
+        self._calls[key] = future
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if future.done():
+                self._calls.pop(key, None)
+            else:
+                future.add_done_callback(lambda _: self._calls.pop(key, None))
+
+    def stats(self):
+        return {'calls': self.calls, 'coalesced': self.coalesced, 'in_flight': len(self._calls)}
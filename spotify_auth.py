@@ -0,0 +1,96 @@
+import base64
+import threading
+import time
+
+import http_client
+import metrics
+
+
+class TokenError(Exception):
+    """Raised when Spotify's token endpoint does not hand out a token"""
+
+    def __init__(self, message, status_code=502):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class AppTokenManager:
+    """Process-wide cache for the client-credentials (app) token.
+
+    The token is kept in memory and refreshed `refresh_margin` seconds before
+    it expires. Refreshing happens under a lock, so when many requests find
+    the token stale at once only one of them calls the token endpoint and
+    the rest reuse its result. Reading a fresh token never takes the lock,
+    so it never waits behind a refresh.
+    """
+
+    def __init__(self, client_id, client_secret, token_url, refresh_margin=60):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.token_url = token_url
+        self.refresh_margin = refresh_margin
+
+        self._lock = threading.Lock()
+        # (token, expires_at), only ever replaced as a whole so readers need no lock
+        self._current = (None, 0.0)
+
+        # counters, read with stats()
+        self.hits = 0
+        self.refreshes = 0
+        self.failures = 0
+
+    def get_token(self):
+        token = self.cached_token()
+        if token is not None:
+            return token
+        with self._lock:
+            # another thread may have refreshed it while this one waited
+            token = self.cached_token()
+            if token is not None:
+                return token
+            return self._refresh()
+
+    def cached_token(self):
+        """Return the token if it is still fresh, None instead of refreshing it"""
+        token, expires_at = self._current
+        if token is not None and time.monotonic() < expires_at:
+            self.hits += 1
+            return token
+        return None
+
+    def invalidate(self):
+        """Drop the cached token, e.g. after Spotify answered 401"""
+        self._current = (None, 0.0)
+
+    def stats(self):
+        token, expires_at = self._current
+        return {
+            'hits': self.hits,
+            'refreshes': self.refreshes,
+            'failures': self.failures,
+            'expires_in': max(0.0, expires_at - time.monotonic()) if token else 0.0,
+        }
+
+    def _refresh(self):
+        credentials = base64.b64encode(f"{self.client_id}:{self.client_secret}".encode()).decode()
+        with metrics.span('spotify_token'):
+            response = http_client.post(self.token_url,
+                                        data={'grant_type': 'client_credentials'},
+                                        headers={
+                                            'Authorization': 'Basic ' + credentials,
+                                            'Content-Type': 'application/x-www-form-urlencoded'
+                                        })
+
+        token_info = response.json() if response.status_code == 200 else {}
+        token = token_info.get('access_token')
+        if token is None:
+            self.failures += 1
+            raise TokenError("Failed to get app token", response.status_code if response.status_code != 200 else 502)
+
+        # Refresh ahead of the real expiry so requests never race a dying token
+        expires_in = token_info.get('expires_in', 3600)
+        lifetime = max(expires_in - self.refresh_margin, expires_in / 2)
+
+        self._current = (token, time.monotonic() + lifetime)
+        self.refreshes += 1
+        return token
@@ -0,0 +1,125 @@
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from palette_cache import PaletteCache
+
+
+# Spotify only treats these as operators when they are upper case
+OPERATORS = ('NOT', 'OR')
+
+
+def normalize_query(query):
+    """Canonical form of a search query, used as cache key only.
+
+    Unicode is NFKC normalized (full-width letters, ligatures and composed
+    accents compare equal), case is folded and runs of whitespace collapse
+    to one space. Spotify search is case-insensitive except for the NOT and
+    OR operators, so those keep their case. The query sent upstream is
+    always the one the user typed.
+
+    >>> normalize_query('  \uff22lue  NOT Train or  Not ')
+    'blue NOT train or not'
+    """
+    words = unicodedata.normalize('NFKC', query).split()
+    return ' '.join(word if word in OPERATORS else word.casefold() for word in words)
+
+
+class SearchCache(PaletteCache):
+    """Short-lived LRU of /v1/search responses keyed by (normalized query, limit, market)"""
+
+    def __init__(self, max_entries=2048, ttl=5 * 60):
+        super().__init__(max_entries=max_entries, ttl=ttl)
+
+
+class CachedAlbum:
+    """An album object with the validators Spotify sent along with it"""
+
+    __slots__ = ('album', 'etag', 'fresh_until')
+
+    def __init__(self, album, etag, fresh_until):
+        self.album = album
+        self.etag = etag
+        self.fresh_until = fresh_until
+
+    @property
+    def fresh(self):
+        return time.monotonic() < self.fresh_until
+
+
+class AlbumCache:
+    """Album metadata keyed by Spotify album ID.
+
+    Albums practically never change, so entries are served without asking
+    Spotify for `ttl` seconds. After that they are kept, not dropped: the
+    next lookup revalidates with If-None-Match and a 304 makes the entry
+    fresh again without downloading or parsing the album JSON.
+    """
+
+    def __init__(self, max_entries=4096, ttl=7 * 24 * 60 * 60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.not_modified = 0
+        self.evictions = 0
+
+    def get(self, album_id):
+        """Return the CachedAlbum for album_id (fresh or stale), or None"""
+        with self._lock:
+            entry = self._entries.get(album_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(album_id)
+            if entry.fresh:
+                self.hits += 1
+            else:
+                self.revalidations += 1
+            return entry
+
+    def set(self, album_id, album, etag=None):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[album_id] = CachedAlbum(album, etag, time.monotonic() + self.ttl)
+            self._entries.move_to_end(album_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def revalidated(self, album_id):
+        """Spotify answered 304 for album_id, keep serving the cached copy"""
+        with self._lock:
+            entry = self._entries.get(album_id)
+            if entry is not None:
+                entry.fresh_until = time.monotonic() + self.ttl
+                self.not_modified += 1
+
+    @staticmethod
+    def conditional_headers(entry, headers):
+        """Request headers for fetching an album, with If-None-Match when we can revalidate"""
+        if entry is None or not entry.etag:
+            return headers
+        return dict(headers, **{'If-None-Match': entry.etag})
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'revalidations': self.revalidations,
+                'not_modified': self.not_modified,
+                'evictions': self.evictions,
+            }
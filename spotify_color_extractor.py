@@ -1,34 +1,143 @@
 import os
-import io
 import json
-import base64
-from urllib.parse import urlencode
-import requests
-from flask import Flask, request, jsonify, render_template, redirect, session
+import math
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlencode, urlparse
+from flask import Blueprint, Flask, Response, g, request, jsonify, render_template, redirect, session, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
-from PIL import Image
-from colorthief import ColorThief
-
-
-load_dotenv('credentials.env')
-
-app = Flask(__name__)
-CORS(app)
-app.secret_key = os.urandom(24)
-
-# Spotify API credentials
-CLIENT_ID = os.getenv('SPOTIFY_CLIENT_ID', '')
-CLIENT_SECRET = os.getenv('SPOTIFY_CLIENT_SECRET', '')
-REDIRECT_URI = os.getenv('REDIRECT_URI', 'http://localhost:5000/callback')
+import numpy as np
+import artwork
+import http_client
+import color_spaces
+import metrics
+from color_index import ColorIndex
+from http_client import RateLimited
+from palette_cache import PaletteCache
+import palette_engines
+import palette_pool as palette_workers
+from palette_engines import ENGINES
+from palette_pool import PalettePool, PaletteQueueFull
+from palette_store import open_palette_store
+import now_playing
+from singleflight import SingleFlight
+from spotify_auth import AppTokenManager, TokenError
+from spotify_cache import AlbumCache, SearchCache, normalize_query
+
+
+routes = Blueprint('palettes', __name__)
+
+# Settings and shared state that come from the environment, set by configure()
+_configure_lock = threading.Lock()
+_configured = False
+
+#reads credentials.env and builds the shared clients, caches and store, once per process
+def configure():
+    global _configured, SECRET_KEY, CLIENT_ID, CLIENT_SECRET, REDIRECT_URI, ACCOUNTS_URL, API_URL
+    global app_tokens, palette_cache, palette_store, album_cache, cover_albums, search_cache
+    global BATCH_LIMIT, batch_executor, ARTWORK_HOSTS, MAX_STREAM_RESULTS, palette_pool
+    with _configure_lock:
+        if _configured:
+            return
+        load_dotenv('credentials.env')
+        # these modules read the environment when imported, before credentials.env was loaded
+        for module in (http_client, artwork, metrics, now_playing, palette_engines, palette_workers):
+            module.load_settings()
+
+        # Set FLASK_SECRET_KEY to share sessions between workers and with async_app.py
+        SECRET_KEY = os.getenv('FLASK_SECRET_KEY') or os.urandom(24)
+
+        # Spotify API credentials
+        CLIENT_ID = os.getenv('SPOTIFY_CLIENT_ID', '')
+        CLIENT_SECRET = os.getenv('SPOTIFY_CLIENT_SECRET', '')
+        REDIRECT_URI = os.getenv('REDIRECT_URI', 'http://localhost:5000/callback')
+        ACCOUNTS_URL = os.getenv('SPOTIFY_ACCOUNTS_URL', 'https://accounts.spotify.com')
+        API_URL = os.getenv('SPOTIFY_API_URL', 'https://api.spotify.com')
+
+        # Spotify's rate limit is per app, every call to it waits its turn under the client ID
+        http_client.govern(ACCOUNTS_URL, CLIENT_ID)
+        http_client.govern(API_URL, CLIENT_ID)
+
+        # Shared client-credentials token for the limited (no login) routes
+        app_tokens = AppTokenManager(CLIENT_ID, CLIENT_SECRET, f"{ACCOUNTS_URL}/api/token")
+
+        # Palettes of recently seen artwork, keyed by (image_url, color_count, quality, engine)
+        palette_cache = PaletteCache(max_entries=int(os.getenv('PALETTE_CACHE_SIZE', '1024')),
+                                     ttl=int(os.getenv('PALETTE_CACHE_TTL', str(24 * 60 * 60))))
+
+        # Palettes persisted on disk and shared by all workers on this host
+        palette_store = open_palette_store(os.getenv('PALETTE_STORE', 'sqlite:///palettes.db'))
+
+        # Album objects by ID, revalidated with ETags once their TTL runs out
+        album_cache = AlbumCache(max_entries=int(os.getenv('ALBUM_CACHE_SIZE', '4096')),
+                                 ttl=int(os.getenv('ALBUM_CACHE_TTL', str(7 * 24 * 60 * 60))))
+
+        # Album details of recently seen covers, written to the store once their palette is indexed
+        cover_albums = PaletteCache(max_entries=int(os.getenv('ALBUM_CACHE_SIZE', '4096')),
+                                    ttl=int(os.getenv('ALBUM_CACHE_TTL', str(7 * 24 * 60 * 60))))
+
+        # Recent search results by normalized query, short-lived so new releases show up
+        search_cache = SearchCache(max_entries=int(os.getenv('SEARCH_CACHE_SIZE', '2048')),
+                                   ttl=int(os.getenv('SEARCH_CACHE_TTL', '300')))
+
+        # POST /palettes: most items per request, and threads downloading artwork for it
+        BATCH_LIMIT = int(os.getenv('PALETTE_BATCH_LIMIT', '50'))
+        batch_executor = ThreadPoolExecutor(max_workers=int(os.getenv('BATCH_CONCURRENCY', '8')),
+                                            thread_name_prefix='palette-batch')
+
+        # Hosts POST /palettes may download images from, '*' allows any
+        ARTWORK_HOSTS = os.getenv('ARTWORK_HOSTS', 'i.scdn.co,mosaic.scdn.co,image-cdn-ak.spotifycdn.com,image-cdn-fa.spotifycdn.com')
+
+        # The most albums one streamed search returns
+        MAX_STREAM_RESULTS = int(os.getenv('MAX_STREAM_RESULTS', '10'))
+
+        # Worker processes that do the CPU-bound palette extraction off the request threads
+        palette_pool = PalettePool()
+        _configured = True
+
+#builds the Flask app, importing this module does no I/O until this runs
+def create_app():
+    configure()
+    # spawn and warm the palette workers now, not on the first extraction
+    palette_pool.start_in_background()
+    app = Flask(__name__)
+    CORS(app)
+    app.secret_key = SECRET_KEY
+    app.register_blueprint(routes)
+    return app
+
+# Identical searches and palette extractions running at the same time share one call
+search_flights = SingleFlight()
+palette_flights = SingleFlight()
+
+# ?stream= formats of the search routes
+STREAM_FORMATS = {'ndjson': 'application/x-ndjson', 'sse': 'text/event-stream'}
+
+# Spotify's multi-album endpoint takes at most this many IDs per call
+ALBUMS_PER_CALL = 20
+# Base62 album IDs, anything else (e.g. a comma) would change what a multi-album call asks for
+ALBUM_ID = re.compile(r'^[0-9A-Za-z]{22}$')
+
+# Pollers of currently-playing behind /current-track/stream, one per listener and engine
+player_watches = now_playing.PlayerWatches()
+
+# Palettes searchable by color through /similar, filled from the store and every new extraction
+color_index = ColorIndex()
+color_index_lock = threading.Lock()
+color_index_loader = None
+# Most colors one /similar query may ask for
+MAX_SIMILAR_COLORS = 10
 
 # Routes
 
-@app.route('/')
+@routes.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/auth')
+@routes.route('/auth')
 def auth():
 
     scope = 'user-read-currently-playing user-read-recently-played'
@@ -42,7 +151,7 @@ def auth():
     auth_url = f"https://accounts.spotify.com/authorize?{urlencode(params)}"
     return redirect(auth_url)
 
-@app.route('/callback')
+@routes.route('/callback')
 def callback():
 
     error = request.args.get('error')
@@ -52,7 +161,7 @@ def callback():
         return redirect('/limited')
 
     auth_options = {
-        'url': 'https://accounts.spotify.com/api/token',
+        'url': f"{ACCOUNTS_URL}/api/token",
         'data': {
             'code': code,
             'redirect_uri': REDIRECT_URI,
@@ -65,9 +174,10 @@ def callback():
         }
     }
 
-    response = requests.post(auth_options['url'],
-                          data=auth_options['data'],
-                          headers=auth_options['headers'])
+    with metrics.span('spotify_token'):
+        response = http_client.post(auth_options['url'],
+                                    data=auth_options['data'],
+                                    headers=auth_options['headers'])
     token_info = response.json()
 
     # Store token in session
@@ -75,7 +185,7 @@ def callback():
 
     return redirect('/app')
 
-@app.route('/limited')
+@routes.route('/limited')
 def limited_access():
     return render_template('limited.html')
 
@@ -94,41 +204,197 @@ def get_artist_name(artists):
     final_artist = ', '.join(artist_name)
     return final_artist
 
-@app.route('/limited-search')
+# Album fields the routes use; search results and the currently playing item
+# already embed them in their simplified album objects
+ALBUM_FIELDS = ('name', 'artists', 'release_date', 'images')
+
+#checks whether an album object has everything the routes need
+def has_album_fields(album):
+    return all(field in album for field in ALBUM_FIELDS)
+
+#returns (album_data, status), fetching the full album only when a field is missing
+def complete_album(album, headers):
+    if has_album_fields(album):
+        return album, 200
+    return fetch_album(album['id'], headers)
+
+#returns the album fields the routes send back and the URL of its largest image
+def album_summary(album_data):
+    images = sorted(album_data['images'], key=image_width, reverse=True)
+    summary = {
+        "name": album_data['name'],
+        "artist": get_artist_name(album_data['artists']),
+        "release_date": album_data['release_date'],
+        "image_url": images[0]['url']
+    }
+    # so /similar can name the album behind a matching cover
+    cover_albums.set(images[0]['url'], dict(summary, id=album_data.get('id')))
+    return summary, images[0]['url']
+
+#returns (album_data, status) for an album ID, going through the album cache
+def fetch_album(album_id, headers):
+    cached = album_cache.get(album_id)
+    if cached is not None and cached.fresh:
+        return cached.album, 200
+
+    try:
+        with metrics.span('spotify_album'):
+            album_response = http_client.get(f"{API_URL}/v1/albums/{album_id}",
+                                             headers=AlbumCache.conditional_headers(cached, headers))
+    except RateLimited:
+        # streamed responses report it per album, like any other failed lookup
+        return None, 429
+
+    # Not modified since we cached it, skip downloading and parsing it again
+    if album_response.status_code == 304 and cached is not None:
+        album_cache.revalidated(album_id)
+        return cached.album, 200
+
+    if album_response.status_code != 200:
+        return None, album_response.status_code
+
+    album_data = album_response.json()
+    album_cache.set(album_id, album_data, album_response.headers.get('ETag'))
+    return album_data, 200
+
+#returns (stream, limit) from ?stream= and ?limit=, limit is None if either is invalid
+def requested_stream():
+    stream = request.args.get('stream')
+    if stream is None:
+        return None, 1
+    if stream not in STREAM_FORMATS:
+        return stream, None
+
+    try:
+        limit = int(request.args.get('limit', 5))
+    except ValueError:
+        return stream, None
+    if limit < 1 or limit > MAX_STREAM_RESULTS:
+        return stream, None
+    return stream, limit
+
+#formats one event of a ?stream= response
+def stream_event(stream, event, payload):
+    if stream == 'sse':
+        return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+    return json.dumps({"type": event, **payload}) + '\n'
+
+#streams search results: every album's details right away, then each palette as it finishes
+def stream_albums(albums, headers, engine, stream):
+
+    def generate():
+        futures = {}
+        for index, album in enumerate(albums):
+            album_data, status = complete_album(album, headers)
+            if album_data is None or len(album_data.get('images', [])) == 0:
+                yield stream_event(stream, 'error', {"index": index, "album_id": album.get('id'),
+                                                     "error": "No album artwork available",
+                                                     "status": status if album_data is None else 404})
+                continue
+
+            summary, image_url = album_summary(album_data)
+            futures[batch_executor.submit(extract_colors, image_url, engine=engine)] = (index, album['id'])
+            yield stream_event(stream, 'album', {"index": index, "album_id": album['id'], "album": summary})
+
+        for future in as_completed(futures):
+            index, album_id = futures[future]
+            try:
+                yield stream_event(stream, 'colors', {"index": index, "album_id": album_id,
+                                                      "colors": future.result()})
+            except PaletteQueueFull:
+                yield stream_event(stream, 'error', {"index": index, "album_id": album_id,
+                                                     "error": "Too many palettes being extracted, try again shortly",
+                                                     "status": 503})
+
+        yield stream_event(stream, 'done', {"count": len(albums)})
+
+    # no-cache and X-Accel-Buffering keep proxies from holding events back
+    return Response(stream_with_context(generate()), mimetype=STREAM_FORMATS[stream],
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+#returns (data, status) of an album search, cached and coalesced by normalized query,
+#searches with a user's token only return albums available in that user's country, which
+#only the token stands for, so those are cached per token instead of shared
+def search_albums(query, headers, limit=1, user_token=False):
+    market = headers.get('Authorization') if user_token else None
+    key = (normalize_query(query), limit, market)
+    cached = search_cache.get(key)
+    if cached is not None:
+        return cached, 200
+
+    def fetch():
+        # params= takes care of URL encoding the query
+        with metrics.span('spotify_search'):
+            response = http_client.get(f"{API_URL}/v1/search",
+                                       params={'q': query, 'type': 'album', 'limit': limit},
+                                       headers=headers)
+        if response.status_code != 200:
+            return None, response.status_code
+        return response.json(), 200
+
+    # Only coalesce calls made with the same token, a follower must not get
+    # another user's 401
+    data, status = search_flights.do(key + (headers.get('Authorization'),), fetch)
+    if data is not None:
+        search_cache.set(key, data)
+    return data, status
+
+#returns the palette engine asked for with ?engine=, None if it is unknown
+def requested_engine():
+    engine = request.args.get('engine', palette_engines.DEFAULT_ENGINE)
+    if engine not in ENGINES:
+        return None
+    return engine
+
+#returns the swatch fields asked for with ?fields=, None if one is unknown
+def requested_fields():
+    fields = [field.strip() for field in request.args.get('fields', '').split(',') if field.strip()]
+    if any(field not in PALETTE_FIELDS for field in fields):
+        return None
+    return fields
+
+#the colors of a response, plus the swatch details ?fields= asked for
+def palette_payload(swatches, fields):
+    payload = {"colors": [color for color, _ in swatches]}
+    if fields:
+        payload["swatches"] = palette_details(swatches, fields)
+    return payload
+
+@routes.route('/limited-search')
 def limited_search_album():
     """Search for an album on Spotify without requiring user authentication"""
     query = request.args.get('q')
     if query is None or query == "":
         return jsonify({"error": "No search query provided"}), 400
 
-    auth_options = {
-        'url': 'https://accounts.spotify.com/api/token',
-        'data': {
-            'grant_type': 'client_credentials'
-        },
-        'headers': {
-            'Authorization': 'Basic ' + base64.b64encode(f"{CLIENT_ID}:{CLIENT_SECRET}".encode()).decode(),
-            'Content-Type': 'application/x-www-form-urlencoded'
-        }
-    }
+    engine = requested_engine()
+    if engine is None:
+        return jsonify({"error": "Unknown palette engine"}), 400
+
+    fields = requested_fields()
+    if fields is None:
+        return jsonify({"error": f"fields must be some of {', '.join(PALETTE_FIELDS)}"}), 400
 
-    token_response = requests.post(auth_options['url'],
-                                   data=auth_options['data'],
-                                   headers=auth_options['headers'])
-    token_info = token_response.json()
-    app_token = token_info.get('access_token')
+    stream, limit = requested_stream()
+    if limit is None:
+        return jsonify({"error": f"stream must be one of {', '.join(STREAM_FORMATS)} and limit between 1 and {MAX_STREAM_RESULTS}"}), 400
+
+    try:
+        app_token = app_tokens.get_token()
+    except TokenError as e:
+        return jsonify({"error": str(e)}), e.status_code
 
     # Use the app token to search spotify
     headers = {'Authorization': f"Bearer {app_token}"}
-    response = requests.get(
-        f"https://api.spotify.com/v1/search?q={query}&type=album&limit=1",
-        headers=headers
-    )
+    data, status = search_albums(query, headers, limit=limit)
 
-    if response.status_code != 200:
-        return jsonify({"error": "Failed to search albums"}), response.status_code
+    if status == 401:
+        # The app token was revoked early, fetch a new one on the next request
+        app_tokens.invalidate()
+
+    if status != 200:
+        return jsonify({"error": "Failed to search albums"}), status
 
-    data = response.json()
     if 'albums' not in data:
         return jsonify({"error": "No albums found"}), 404
     if 'items' not in data['albums']:
@@ -136,57 +402,57 @@ def limited_search_album():
     if len(data['albums']['items']) == 0:
         return jsonify({"error": "No albums found"}), 404
 
-    album = data['albums']['items'][0]
-    album_id = album['id']
-
-    # Get detailed album info
-    album_response = requests.get(f"https://api.spotify.com/v1/albums/{album_id}", headers=headers)
+    if stream is not None:
+        return stream_albums(data['albums']['items'], headers, engine, stream)
 
-    if album_response.status_code != 200:
-        return jsonify({"error": "Failed to get album details"}), album_response.status_code
+    album = data['albums']['items'][0]
 
-    album_data = album_response.json()
+    # The search result already carries the album details we need
+    album_data, status = complete_album(album, headers)
+    if album_data is None:
+        return jsonify({"error": "Failed to get album details"}), status
 
     # Get the largest image
     if 'images' not in album_data or len(album_data['images']) == 0:
         return jsonify({"error": "No artwork available"}), 404
 
-    images = sorted(album_data['images'], key = image_width, reverse = True)
-    image_url = images[0]['url']
+    summary, image_url = album_summary(album_data)
 
     # extract colors
-    palette = extract_colors(image_url)
-
-    final_artist = get_artist_name(album_data['artists'])
+    swatches = extract_swatches(image_url, engine=engine)
 
     return jsonify({
-        "album": {
-            "name": album_data['name'],
-            "artist": final_artist,
-            "release_date": album_data['release_date'],
-            "image_url": image_url
-        },
-        "colors": palette
+        "album": summary,
+        **palette_payload(swatches, fields)
     })
 
 
 
 
-@app.route('/app')
+@routes.route('/app')
 def app_page():
 
     if 'access_token' not in session:
         return redirect('/auth')
     return render_template('app.html', token=session['access_token'])
 
-@app.route('/current-track')
+@routes.route('/current-track')
 def get_current_track():
 
     if 'access_token' not in session:
         return jsonify({"error": "Not authenticated"}), 401
 
+    engine = requested_engine()
+    if engine is None:
+        return jsonify({"error": "Unknown palette engine"}), 400
+
+    fields = requested_fields()
+    if fields is None:
+        return jsonify({"error": f"fields must be some of {', '.join(PALETTE_FIELDS)}"}), 400
+
     headers = {'Authorization': f"Bearer {session['access_token']}"}
-    response = requests.get('https://api.spotify.com/v1/me/player/currently-playing', headers=headers)
+    with metrics.span('spotify_player'):
+        response = http_client.get(f"{API_URL}/v1/me/player/currently-playing", headers=headers)
 
     if response.status_code == 204:
         return jsonify({"error": "No track currently playing"}), 404
@@ -198,39 +464,127 @@ def get_current_track():
     if 'item' not in data:
         return jsonify({"error": "No track information available"}), 404
 
-    # get album details
-    album_id = data['item']['album']['id']
-    album_response = requests.get(f"https://api.spotify.com/v1/albums/{album_id}", headers=headers)
-
-    if album_response.status_code != 200:
-        return jsonify({"error": "Failed to get album details"}), album_response.status_code
-
-    album_data = album_response.json()
+    # get album details, the playing item already embeds its album
+    album_data, status = complete_album(data['item']['album'], headers)
+    if album_data is None:
+        return jsonify({"error": "Failed to get album details"}), status
 
     # Get the largest image
     if 'images' not in album_data or len(album_data['images']) == 0:
         return jsonify({"error": "No album artwork available"}), 404
 
-    images = sorted(album_data['images'], key= image_width, reverse=True)
-    image_url = images[0]['url']
+    _, image_url = album_summary(album_data)
 
     # Extract coloors
-    palette = extract_colors(image_url)
-
-    final_artist = get_artist_name(album_data['artists'])
+    swatches = extract_swatches(image_url, engine=engine)
 
     return jsonify({
-        "track": {
-            "name": data['item']['name'],
-            "artist": final_artist,
-            "album": album_data['name'],
-            "release_date": album_data['release_date'],
-            "image_url": image_url
-        },
-        "colors": palette
+        "track": track_summary(data['item'], album_data, image_url),
+        **palette_payload(swatches, fields)
     })
 
-@app.route('/search')
+@routes.route('/current-track/stream')
+def current_track_stream():
+    """Server-Sent Events with the current track and its palette, sent whenever the track changes"""
+    if 'access_token' not in session:
+        return jsonify({"error": "Not authenticated"}), 401
+
+    engine = requested_engine()
+    if engine is None:
+        return jsonify({"error": "Unknown palette engine"}), 400
+
+    # Tabs of the same listener share one poller
+    access_token = session['access_token']
+    headers = {'Authorization': f"Bearer {access_token}"}
+
+    def poll(state):
+        # a live page can wait a moment, /current-track requests go first
+        with http_client.priority(http_client.BACKGROUND):
+            return poll_current_track(headers, engine, state)
+
+    watch, subscriber = player_watches.subscribe((access_token, engine), poll)
+
+    def generate():
+        for item in now_playing.listen(watch, subscriber):
+            if item is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield stream_event('sse', *item)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+#the track fields /current-track sends back
+def track_summary(item, album_data, image_url):
+    return {
+        "name": item['name'],
+        "artist": get_artist_name(album_data['artists']),
+        "album": album_data['name'],
+        "release_date": album_data['release_date'],
+        "image_url": image_url
+    }
+
+#one poll of a listener's player, returns (events, seconds until the next poll or None to stop)
+def poll_current_track(headers, engine, state):
+    try:
+        with metrics.span('spotify_player'):
+            response = http_client.get(f"{API_URL}/v1/me/player/currently-playing", headers=headers)
+    except RateLimited as e:
+        return [], max(e.retry_after, now_playing.INTERVAL)
+
+    if response.status_code == 401:
+        return [('error', {"error": "Not authenticated", "status": 401})], None
+
+    if response.status_code not in (200, 204):
+        if state.get('status') == response.status_code:
+            return [], now_playing.IDLE_INTERVAL
+        state['status'] = response.status_code
+        return [('error', {"error": "Failed to get current track", "status": response.status_code})], now_playing.IDLE_INTERVAL
+
+    data = response.json() if response.status_code == 200 else {}
+    item = data.get('item')
+    if item is None or 'album' not in item:
+        # nothing playing, or an episode, tell the page once and check back slowly
+        if state.get('status') == 204:
+            return [], now_playing.IDLE_INTERVAL
+        state.update(status=204, track_id=None)
+        return [('idle', {"error": "No track currently playing"})], now_playing.IDLE_INTERVAL
+
+    delay = now_playing.INTERVAL if data.get('is_playing') else now_playing.IDLE_INTERVAL
+    if data.get('is_playing') and item.get('duration_ms') and data.get('progress_ms') is not None:
+        # check again right after the track ends instead of up to a whole interval later
+        remaining = (item['duration_ms'] - data['progress_ms']) / 1000
+        delay = min(delay, max(remaining + 0.5, 1))
+
+    track_id = item.get('id') or item.get('uri') or item['name']
+    if track_id == state.get('track_id'):
+        return [], delay
+
+    # only a new album needs its details and artwork, the next track of the same one reuses them
+    album_id = item['album'].get('id')
+    if album_id is None or album_id != state.get('album_id'):
+        album_data, status = complete_album(item['album'], headers)
+        if album_data is None:
+            return [('error', {"error": "Failed to get album details", "status": status})], delay
+        if len(album_data.get('images', [])) == 0:
+            state.update(status=200, track_id=track_id, album_id=None)
+            return [('error', {"error": "No album artwork available", "status": 404})], delay
+
+        _, image_url = album_summary(album_data)
+        try:
+            colors = extract_colors(image_url, engine=engine)
+        except PaletteQueueFull:
+            # leave the state alone so the next poll tries again
+            return [], now_playing.INTERVAL
+        state.update(album_id=album_id, album=album_data, image_url=image_url, colors=colors)
+
+    state.update(status=200, track_id=track_id)
+    return [('track', {
+        "track": track_summary(item, state['album'], state['image_url']),
+        "colors": state['colors']
+    })], delay
+
+@routes.route('/search')
 def search_album():
     """Search for an album on Spotify"""
     if 'access_token' not in session:
@@ -240,16 +594,24 @@ def search_album():
     if query is None or query == "":
         return jsonify({"error": "No search query provided"}), 400
 
+    engine = requested_engine()
+    if engine is None:
+        return jsonify({"error": "Unknown palette engine"}), 400
+
+    fields = requested_fields()
+    if fields is None:
+        return jsonify({"error": f"fields must be some of {', '.join(PALETTE_FIELDS)}"}), 400
+
+    stream, limit = requested_stream()
+    if limit is None:
+        return jsonify({"error": f"stream must be one of {', '.join(STREAM_FORMATS)} and limit between 1 and {MAX_STREAM_RESULTS}"}), 400
+
     headers = {'Authorization': f"Bearer {session['access_token']}"}
-    response = requests.get(
-        f"https://api.spotify.com/v1/search?q={query}&type=album&limit=1",
-        headers=headers
-    )
+    data, status = search_albums(query, headers, limit=limit, user_token=True)
 
-    if response.status_code != 200:
-        return jsonify({"error": "Failed to search albums"}), response.status_code
+    if status != 200:
+        return jsonify({"error": "Failed to search albums"}), status
 
-    data = response.json()
     if 'albums' not in data:
         return jsonify({"error": "No albums found"}), 404
     if 'items' not in data['albums']:
@@ -257,485 +619,482 @@ def search_album():
     if len(data['albums']['items']) == 0:
         return jsonify({"error": "No albums found"}), 404
 
-    album = data['albums']['items'][0]
-    album_id = album['id']
+    if stream is not None:
+        return stream_albums(data['albums']['items'], headers, engine, stream)
 
-    # Get detailed album info
-    album_response = requests.get(f"https://api.spotify.com/v1/albums/{album_id}", headers=headers)
-
-    if album_response.status_code != 200:
-        return jsonify({"error": "Failed to get album details"}), album_response.status_code
+    album = data['albums']['items'][0]
 
-    album_data = album_response.json()
+    # The search result already carries the album details we need
+    album_data, status = complete_album(album, headers)
+    if album_data is None:
+        return jsonify({"error": "Failed to get album details"}), status
 
     # Get the largest image
-    if 'images' not in album_data:
+    if len(album_data.get('images', [])) == 0:
         return jsonify({"error": "No album artwork available"}), 404
 
-    images = sorted(album_data['images'], key=image_width, reverse=True)
-    image_url = images[0]['url']
+    summary, image_url = album_summary(album_data)
 
     # extract colors
-    palette = extract_colors(image_url)
-
-    final_artist = get_artist_name(album_data['artists'])
+    swatches = extract_swatches(image_url, engine=engine)
 
     return jsonify({
-        "album": {
-            "name": album_data['name'],
-            "artist": final_artist,
-            "release_date": album_data['release_date'],
-            "image_url": image_url
-        },
-        "colors": palette
+        "album": summary,
+        **palette_payload(swatches, fields)
     })
 
-def rgb_to_hex(rgb_tuple):
+@routes.route('/palettes', methods=['POST'])
+def batch_palettes():
+    """Palettes for many albums and/or image URLs in one request"""
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify({"error": "Expected a JSON object"}), 400
+
+    album_ids = body.get('albums', [])
+    image_urls = body.get('images', [])
+    if not is_string_list(album_ids) or not is_string_list(image_urls):
+        return jsonify({"error": "albums and images must be lists of strings"}), 400
+    if len(album_ids) == 0 and len(image_urls) == 0:
+        return jsonify({"error": "No albums or images provided"}), 400
+    if len(album_ids) + len(image_urls) > BATCH_LIMIT:
+        return jsonify({"error": f"At most {BATCH_LIMIT} albums and images per request"}), 400
+
+    engine = body.get('engine', palette_engines.DEFAULT_ENGINE)
+    if not isinstance(engine, str) or engine not in ENGINES:
+        return jsonify({"error": "Unknown palette engine"}), 400
+
+    albums = {}
+    failed = {}
+    if album_ids:
+        # Logged in users search with their own token, everyone else with the app token
+        if 'access_token' in session:
+            token = session['access_token']
+        else:
+            try:
+                token = app_tokens.get_token()
+            except TokenError as e:
+                return jsonify({"error": str(e)}), e.status_code
+        with http_client.priority(http_client.BATCH):
+            albums, failed = fetch_albums(album_ids, {'Authorization': f"Bearer {token}"})
+
+    # Work out what to download first, then download and extract everything concurrently
+    results = []
+    jobs = []
+    for album_id in album_ids:
+        if not ALBUM_ID.match(album_id):
+            results.append({"album_id": album_id, "error": "Not a Spotify album ID", "status": 400})
+            continue
+        album_data = albums.get(album_id)
+        if album_data is None:
+            results.append({"album_id": album_id, "error": "Failed to get album details",
+                            "status": failed.get(album_id, 404)})
+            continue
+        if len(album_data.get('images', [])) == 0:
+            results.append({"album_id": album_id, "error": "No album artwork available", "status": 404})
+            continue
+
+        summary, image_url = album_summary(album_data)
+        result = {"album_id": album_id, "album": summary}
+        results.append(result)
+        jobs.append((result, image_url))
+
+    for image_url in image_urls:
+        result = {"image_url": image_url}
+        results.append(result)
+        if not is_artwork_url(image_url):
+            result.update({"error": "Image host not allowed", "status": 400})
+            continue
+        jobs.append((result, image_url))
+
+    futures = [(result, batch_executor.submit(extract_colors, image_url, engine=engine))
+               for result, image_url in jobs]
+    for result, future in futures:
+        try:
+            result["colors"] = future.result()
+        except PaletteQueueFull:
+            result.update({"error": "Too many palettes being extracted, try again shortly", "status": 503})
+
+    return jsonify({"results": results})
+
+@routes.route('/recently-played')
+def recently_played():
+    """Palettes of the albums behind the last 50 played tracks, streamed as NDJSON"""
+    if 'access_token' not in session:
+        return jsonify({"error": "Not authenticated"}), 401
 
-    r = rgb_tuple[0]
-    b = rgb_tuple[1]
-    g = rgb_tuple[2]
-    hex_color = '#%02x%02x%02x' % (r, g, b)
-    return hex_color
+    engine = requested_engine()
+    if engine is None:
+        return jsonify({"error": "Unknown palette engine"}), 400
 
-def extract_colors(image_url, color_count=5):
+    headers = {'Authorization': f"Bearer {session['access_token']}"}
+    with metrics.span('spotify_recently_played'):
+        response = http_client.get(f"{API_URL}/v1/me/player/recently-played",
+                                   params={'limit': 50}, headers=headers)
+    if response.status_code != 200:
+        return jsonify({"error": "Failed to get recently played tracks"}), response.status_code
+
+    # Albums in play order, each listing its tracks, so every cover is processed once
+    albums = {}
+    for item in response.json().get('items', []):
+        track = item.get('track') or {}
+        album = track.get('album')
+        if album is None or 'id' not in album:
+            continue
+        entry = albums.setdefault(album['id'], {"album": album, "tracks": []})
+        entry["tracks"].append({"name": track.get('name'), "played_at": item.get('played_at')})
+
+    def generate():
+        futures = {}
+        for album_id, entry in albums.items():
+            album_data, status = complete_album(entry["album"], headers)
+            if album_data is None:
+                yield ndjson_line({"album_id": album_id, "tracks": entry["tracks"],
+                                   "error": "Failed to get album details", "status": status})
+                continue
+            if len(album_data.get('images', [])) == 0:
+                yield ndjson_line({"album_id": album_id, "tracks": entry["tracks"],
+                                   "error": "No album artwork available", "status": 404})
+                continue
+            summary, image_url = album_summary(album_data)
+            result = {"album_id": album_id, "album": summary, "tracks": entry["tracks"]}
+            futures[batch_executor.submit(extract_colors, image_url, engine=engine)] = result
+
+        # Send each palette as soon as it is ready rather than in play order
+        for future in as_completed(futures):
+            result = futures[future]
+            try:
+                result["colors"] = future.result()
+            except PaletteQueueFull:
+                result.update({"error": "Too many palettes being extracted, try again shortly", "status": 503})
+            yield ndjson_line(result)
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@routes.route('/similar')
+def similar_albums():
+    """Covers whose palettes are closest to ?colors=#1F1A3F,#CD904D"""
+    colors = [color.strip() for color in request.args.get('colors', '').split(',') if color.strip()]
+    if len(colors) == 0 or len(colors) > MAX_SIMILAR_COLORS:
+        return jsonify({"error": f"Give between 1 and {MAX_SIMILAR_COLORS} colors"}), 400
 
     try:
-        # Download the image
-        response = requests.get(image_url)
-        img = Image.open(io.BytesIO(response.content))
-
-        # Save to a temporary file because ColorThief needs a file-like object
-        temp_img = io.BytesIO()
-        img.save(temp_img, format='PNG')
-        temp_img.seek(0)
-
-        # Extract the palette
-        color_thief = ColorThief(temp_img)
-        palette = color_thief.get_palette(color_count=color_count, quality=10)
-
-        # Convert to hex codes
-        hex_colors = []
-        for rgb in palette:
-            hex_color = rgb_to_hex(rgb)
-            hex_colors.append(hex_color)
-        return hex_colors
+        k = int(request.args.get('k', 10))
+    except ValueError:
+        k = 0
+    if k < 1 or k > 100:
+        return jsonify({"error": "k must be between 1 and 100"}), 400
 
-    except Exception as e:
-        print(f"Error extracting colors: {e}")
-        # Return some default colors in case of error
-        return ["#4FB3BF", "#CD904D", "#1F1A3F", "#A0B5BE", "#8B4513"]
-
-# Create necessary directories for templates
-if not os.path.exists('templates'):
-    os.makedirs('templates')
-
-# Create HTML templates
-with open('templates/index.html', 'w') as f:
-    f.write('''
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Spotify Album Color Palette</title>
-    <style>
-        body {
-            font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-            background-color: #121212;
-            color: #ffffff;
-            margin: 0;
-            padding: 0;
-            display: flex;
-            justify-content: center;
-            align-items: center;
-            height: 100vh;
-            text-align: center;
-        }
-        .container {
-            max-width: 600px;
-            padding: 40px;
-            background-color: #1e1e1e;
-            border-radius: 10px;
-            box-shadow: 0 4px 15px rgba(0, 0, 0, 0.3);
-        }
-        h1 {
-            margin-bottom: 30px;
-            font-size: 2.5rem;
-        }
-        p {
-            margin-bottom: 30px;
-            font-size: 1.1rem;
-            color: #b3b3b3;
-        }
-        .login-button {
-            background-color: #1DB954;
-            color: white;
-            border: none;
-            padding: 15px 30px;
-            border-radius: 30px;
-            font-size: 1.1rem;
-            cursor: pointer;
-            transition: background-color 0.3s, transform 0.2s;
-            font-weight: 600;
-            letter-spacing: 0.5px;
-        }
-        .login-button:hover {
-            background-color: #1ed760;
-            transform: scale(1.05);
-        }
-    </style>
-</head>
-<body>
-    <div class="container">
-        <h1>Spotify Album Color Palette</h1>
-        <p>Extract dominant colors from your favorite album artwork or currently playing track.</p>
-        <a href="/auth" class="login-button">Connect with Spotify</a>
-    </div>
-</body>
-</html>
-    ''')
-
-with open('templates/app.html', 'w') as f:
-    f.write('''
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Spotify Album Color Palette</title>
-    <style>
-        body {
-            font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-            background-color: #121212;
-            color: #ffffff;
-            margin: 0;
-            padding: 20px;
-            display: flex;
-            flex-direction: column;
-            align-items: center;
-        }
-
-        h1 {
-            margin-bottom: 30px;
-        }
-
-        .container {
-            display: flex;
-            flex-direction: column;
-            align-items: center;
-            max-width: 800px;
-            width: 100%;
-        }
-
-        .search-container {
-            width: 100%;
-            margin-bottom: 30px;
-            display: flex;
-            flex-direction: column;
-            align-items: center;
-        }
-
-        .search-box {
-            display: flex;
-            width: 100%;
-            max-width: 500px;
-        }
-
-        input {
-            flex-grow: 1;
-            padding: 10px;
-            border: none;
-            border-radius: 4px 0 0 4px;
-            font-size: 16px;
-        }
-
-        button {
-            background-color: #1DB954;
-            color: white;
-            border: none;
-            padding: 10px 20px;
-            border-radius: 4px;
-            cursor: pointer;
-            font-size: 16px;
-            transition: background-color 0.3s;
-        }
-
-        .search-box button {
-            border-radius: 0 4px 4px 0;
-        }
-
-        button:hover {
-            background-color: #1ed760;
-        }
-
-        .result-container {
-            display: flex;
-            flex-direction: column;
-            align-items: center;
-            width: 100%;
-            margin-top: 20px;
-        }
-
-        .album-info {
-            display: flex;
-            flex-direction: column;
-            align-items: center;
-            margin-bottom: 20px;
-        }
-
-        .album-info img {
-            width: 300px;
-            height: 300px;
-            margin-bottom: 15px;
-            box-shadow: 0 4px 15px rgba(0, 0, 0, 0.3);
-        }
-
-        .album-details {
-            text-align: center;
-            margin-bottom: 20px;
-        }
-
-        .album-details h2 {
-            margin-bottom: 5px;
-        }
-
-        .album-details p {
-            margin: 5px 0;
-            color: #b3b3b3;
-        }
-
-        .color-palette {
-            display: flex;
-            flex-wrap: wrap;
-            justify-content: center;
-            margin-top: 20px;
-            width: 100%;
-        }
-
-        .color-box {
-            width: 120px;
-            height: 120px;
-            margin: 10px;
-            border-radius: 8px;
-            display: flex;
-            flex-direction: column;
-            justify-content: flex-end;
-            align-items: center;
-            box-shadow: 0 4px 10px rgba(0, 0, 0, 0.2);
-            overflow: hidden;
-        }
-
-        .color-code {
-            background-color: rgba(255, 255, 255, 0.85);
-            width: 100%;
-            padding: 8px 0;
-            text-align: center;
-            color: #333;
-            font-weight: bold;
-            font-family: monospace;
-            font-size: 14px;
-        }
-
-        .loading {
-            display: none;
-            margin-top: 20px;
-        }
-
-        .spinner {
-            border: 4px solid rgba(255, 255, 255, 0.3);
-            border-radius: 50%;
-            border-top: 4px solid #1DB954;
-            width: 30px;
-            height: 30px;
-            animation: spin 1s linear infinite;
-        }
-
-        @keyframes spin {
-            0% { transform: rotate(0deg); }
-            100% { transform: rotate(360deg); }
-        }
-
-        .error-message {
-            color: #ff5555;
-            margin-top: 10px;
-            text-align: center;
-            display: none;
-        }
-    </style>
-</head>
-<body>
-    <div class="container">
-        <h1>Spotify Album Color Palette</h1>
-
-        <div class="search-container">
-            <div class="search-box">
-                <input type="text" id="search-input" placeholder="Search for an album...">
-                <button id="search-button">Search</button>
-            </div>
-            <p>Or view your currently playing track:</p>
-            <button id="current-button">Get Current Track</button>
-        </div>
-
-        <div class="loading" id="loading">
-            <div class="spinner"></div>
-            <p>Extracting colors...</p>
-        </div>
-
-        <div class="error-message" id="error-message"></div>
-
-        <div class="result-container" id="result" style="display: none;">
-            <div class="album-info">
-                <img id="album-cover" src="" alt="Album cover">
-                <div class="album-details">
-                    <h2 id="album-name"></h2>
-                    <p id="artist-name"></p>
-                    <p id="release-date"></p>
-                </div>
-            </div>
-
-            <div class="color-palette" id="color-palette"></div>
-        </div>
-    </div>
-
-    <script>
-        // Get access token passed from Flask
-        const token = "{{ token }}";
-
-        // DOM elements
-        const searchInput = document.getElementById('search-input');
-        const searchButton = document.getElementById('search-button');
-        const currentButton = document.getElementById('current-button');
-        const resultSection = document.getElementById('result');
-        const loadingSection = document.getElementById('loading');
-        const errorMessage = document.getElementById('error-message');
-
-        const albumCover = document.getElementById('album-cover');
-        const albumName = document.getElementById('album-name');
-        const artistName = document.getElementById('artist-name');
-        const releaseDate = document.getElementById('release-date');
-        const colorPalette = document.getElementById('color-palette');
-
-        // Event listeners
-        searchButton.addEventListener('click', searchAlbums);
-        currentButton.addEventListener('click', getCurrentTrack);
-        searchInput.addEventListener('keyup', function(event) {
-            if (event.key === 'Enter') {
-                searchAlbums();
-            }
-        });
-
-        function searchAlbums() {
-            const query = searchInput.value.trim();
-            if (!query) return;
-
-            loadingSection.style.display = 'flex';
-            resultSection.style.display = 'none';
-            errorMessage.style.display = 'none';
-
-            fetch(`/search?q=${encodeURIComponent(query)}`)
-                .then(response => {
-                    if (!response.ok) {
-                        return response.json().then(data => {
-                            throw new Error(data.error || 'Failed to search albums');
-                        });
-                    }
-                    return response.json();
-                })
-                .then(data => {
-                    displayAlbumInfo(data);
-                })
-                .catch(error => {
-                    showError(error.message);
-                });
-        }
-
-        function getCurrentTrack() {
-            loadingSection.style.display = 'flex';
-            resultSection.style.display = 'none';
-            errorMessage.style.display = 'none';
-
-            fetch('/current-track')
-                .then(response => {
-                    if (!response.ok) {
-                        return response.json().then(data => {
-                            throw new Error(data.error || 'Failed to get current track');
-                        });
-                    }
-                    return response.json();
-                })
-                .then(data => {
-                    displayTrackInfo(data);
-                })
-                .catch(error => {
-                    showError(error.message);
-                });
-        }
-
-        function displayAlbumInfo(data) {
-            // Set album details
-            albumName.textContent = data.album.name;
-            artistName.textContent = data.album.artist;
-            releaseDate.textContent = `Released: ${formatDate(data.album.release_date)}`;
-            albumCover.src = data.album.image_url;
+    loading = load_color_index()
+    try:
+        with metrics.span('color_index_query'):
+            matches = color_index.query(colors, k)
+    except ValueError:
+        return jsonify({"error": "Colors must be hex codes such as #1F1A3F"}), 400
+
+    results = []
+    for image_url, distance, palette in matches:
+        result = {"image_url": image_url, "distance": round(distance, 2), "colors": palette}
+        album = cover_album(image_url)
+        if album is not None:
+            result["album"] = album
+        results.append(result)
+
+    # while loading, results only cover the palettes read from the store so far
+    return jsonify({"results": results, "indexed": len(color_index), "loading": loading})
+
+#one line of a newline delimited JSON stream
+def ndjson_line(payload):
+    return json.dumps(payload) + '\n'
+
+#checks that a JSON value is a list of strings
+def is_string_list(value):
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+#checks that an image URL points at a host we are willing to download from
+def is_artwork_url(image_url):
+    try:
+        url = urlparse(image_url)
+    except ValueError:
+        # e.g. an unclosed IPv6 bracket
+        return False
+    if url.scheme not in ('http', 'https') or not url.hostname:
+        return False
+    if ARTWORK_HOSTS.strip() == '*':
+        return True
+    return url.hostname in [host.strip() for host in ARTWORK_HOSTS.split(',')]
+
+#returns ({album_id: album_data}, {album_id: status}) using the multi-album endpoint,
+#malformed IDs fail with 400 without a call
+def fetch_albums(album_ids, headers):
+    albums = {}
+    missing = []
+    failed = {}
+    for album_id in dict.fromkeys(album_ids):
+        if not ALBUM_ID.match(album_id):
+            failed[album_id] = 400
+            continue
+        cached = album_cache.get(album_id)
+        if cached is not None and cached.fresh:
+            albums[album_id] = cached.album
+        else:
+            missing.append(album_id)
+
+    # the chunks are fetched on other threads, at the caller's priority
+    level = http_client.current_priority()
+
+    def fetch_chunk(chunk):
+        try:
+            with http_client.priority(level), metrics.span('spotify_albums'):
+                response = http_client.get(f"{API_URL}/v1/albums", params={'ids': ','.join(chunk)},
+                                           headers=headers)
+        except RateLimited:
+            return chunk, None, 429
+        if response.status_code != 200:
+            return chunk, None, response.status_code
+        return chunk, response.json().get('albums', []), 200
+
+    chunks = [missing[i:i + ALBUMS_PER_CALL] for i in range(0, len(missing), ALBUMS_PER_CALL)]
+    for chunk, found, status in batch_executor.map(fetch_chunk, chunks):
+        if found is None:
+            failed.update((album_id, status) for album_id in chunk)
+            continue
+        # matched by the ID each album carries, Spotify returns null for IDs it does not know
+        by_id = {album_data['id']: album_data for album_data in found if album_data and 'id' in album_data}
+        for album_id in chunk:
+            album_data = by_id.get(album_id)
+            if album_data is None:
+                failed[album_id] = 404
+            else:
+                albums[album_id] = album_data
+                album_cache.set(album_id, album_data)
+    return albums, failed
 
-            // Create color palette
-            createColorPalette(data.colors);
+def rgb_to_hex(rgb_tuple):
+    """Hex code of one (r, g, b) color
+
+    >>> rgb_to_hex((0x12, 0x34, 0x56))
+    '#123456'
+    """
+    return color_spaces.rgb_to_hex([rgb_tuple])[0]
+
+# Returned when the artwork cannot be downloaded or decoded
+DEFAULT_COLORS = ["#4FB3BF", "#CD904D", "#1F1A3F", "#A0B5BE", "#8B4513"]
+DEFAULT_SWATCHES = [(color, 0) for color in DEFAULT_COLORS]
+
+# Per-swatch values ?fields= can ask for
+PALETTE_FIELDS = ('hex', 'rgb', 'hsl', 'lab', 'coverage')
+
+# The in-memory caches count their own hits, the store is counted here
+store_lookups = metrics.Counter('palette_store_lookups_total',
+                                'Palette store lookups after an in-memory miss', ('result',))
+
+#returns a palette we already know as [(hex, pixel_count)], from this process or the shared store
+def lookup_colors(key):
+    cached = palette_cache.get(key)
+    if cached is not None:
+        return list(cached)
+    return stored_colors(key)
+
+#returns a palette from the shared store and caches it in this process, None if it is not there
+def stored_colors(key):
+    # Another worker (or this one before a restart) may already have it
+    stored = stored_swatches(palette_store.get(key))
+    if stored is not None:
+        store_lookups.inc('hit')
+        palette_cache.set(key, tuple(stored))
+        return stored
+    store_lookups.inc('miss')
+    return None
+
+#[(hex, pixel_count)] of a stored palette, None for palettes stored as bare hex codes,
+#which were written before the green/blue fix in rgb_to_hex, or holding codes like #1000404
+#from before channels were clipped, both are extracted again
+def stored_swatches(stored):
+    if not stored or not all(isinstance(swatch, list) and len(swatch) == 2
+                             and color_spaces.is_hex_color(swatch[0]) for swatch in stored):
+        return None
+    return [(color, count) for color, count in stored]
+
+#remembers a freshly extracted palette, only real palettes are ever cached
+def remember_colors(key, swatches):
+    palette_cache.set(key, tuple(swatches))
+    palette_store.set(key, [[color, count] for color, count in swatches])
+    if indexed_palette(key):
+        index_palette(key[0], swatches)
+
+#adds a new palette to the color index and stores its album, a failure only costs /similar the cover
+def index_palette(image_url, swatches):
+    try:
+        color_index.add(image_url, [color for color, _ in swatches])
+    except Exception as e:
+        print(f"Error indexing palette of {image_url}: {e}")
+        return
+    album = cover_albums.get(image_url)
+    if album is not None:
+        palette_store.set_album(image_url, album)
+
+#album details of a cover in the color index, from this process or the store
+def cover_album(image_url):
+    album = cover_albums.get(image_url)
+    if album is None:
+        album = palette_store.get_album(image_url)
+    return album
+
+#per-swatch values for ?fields=, each converted in one pass over the whole palette
+def palette_details(swatches, fields):
+    hex_colors = [color for color, _ in swatches]
+    rgb = color_spaces.hex_to_rgb(hex_colors)
+
+    columns = {}
+    if 'hex' in fields:
+        columns['hex'] = hex_colors
+    if 'rgb' in fields:
+        columns['rgb'] = rgb.tolist()
+    if 'hsl' in fields:
+        columns['hsl'] = color_spaces.rgb_to_hsl(rgb).round(1).tolist()
+    if 'lab' in fields:
+        columns['lab'] = color_spaces.rgb_to_lab(rgb).round(2).tolist()
+    if 'coverage' in fields:
+        # share of the sampled pixels each swatch stands for, in percent
+        counts = np.array([count for _, count in swatches], dtype=np.float64)
+        total = counts.sum()
+        columns['coverage'] = (counts * 100 / total if total else counts).round(1).tolist()
+
+    return [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+#only the palettes routes return by default go in the color index, one per cover
+def indexed_palette(key):
+    return len(key) == 4 and key[1:] == (5, 10, palette_engines.DEFAULT_ENGINE)
+
+#fills the color index from the palette store once, in the background, returns True while loading
+def load_color_index():
+    global color_index_loader
+    with color_index_lock:
+        if color_index_loader is None:
+            color_index_loader = threading.Thread(target=read_color_index, name='color-index-loader',
+                                                  daemon=True)
+            color_index_loader.start()
+    return color_index_loader.is_alive()
+
+def read_color_index(batch_size=10000):
+    batch = []
+    for key, colors in palette_store.items():
+        swatches = stored_swatches(colors)
+        if indexed_palette(key) and swatches is not None:
+            batch.append((key[0], [color for color, _ in swatches]))
+        if len(batch) >= batch_size:
+            index_palettes(batch)
+            batch = []
+    index_palettes(batch)
+
+def index_palettes(palettes):
+    try:
+        color_index.add_many(palettes)
+    except ValueError as e:
+        print(f"Error indexing stored palettes: {e}")
 
-            // Show results
-            loadingSection.style.display = 'none';
-            resultSection.style.display = 'flex';
-        }
+def extract_colors(image_url, color_count=5, quality=10, engine=None):
+    return [color for color, _ in extract_swatches(image_url, color_count, quality, engine)]
 
-        function displayTrackInfo(data) {
-            // Set track details
-            albumName.textContent = data.track.album;
-            artistName.textContent = data.track.artist;
-            releaseDate.textContent = `Track: ${data.track.name}`;
-            albumCover.src = data.track.image_url;
+#returns the palette of an image as [(hex, pixel_count)]
+def extract_swatches(image_url, color_count=5, quality=10, engine=None):
+    if engine is None:
+        engine = palette_engines.DEFAULT_ENGINE
+    key = (image_url, color_count, quality, engine)
+    known = lookup_colors(key)
+    if known is not None:
+        return known
 
-            // Create color palette
-            createColorPalette(data.colors);
+    # Requests for the same cover at the same time share one download and extraction
+    return list(palette_flights.do(key, download_colors, key, image_url, color_count, quality, engine))
 
-            // Show results
-            loadingSection.style.display = 'none';
-            resultSection.style.display = 'flex';
-        }
+def download_colors(key, image_url, color_count, quality, engine):
 
-        function createColorPalette(colors) {
-            // Clear previous palette
-            colorPalette.innerHTML = '';
+    try:
+        # Download the image, bounded in size and time and cached on disk
+        data = artwork.download(image_url)
 
-            // Create color boxes
-            colors.forEach(color => {
-                const colorBox = document.createElement('div');
-                colorBox.className = 'color-box';
-                colorBox.style.backgroundColor = color;
+        # Decode and extract the palette in a worker process
+        with metrics.span('palette_extract'):
+            swatches = palette_pool.extract(data, color_count=color_count,
+                                            quality=quality, engine=engine)
 
-                const colorCode = document.createElement('div');
-                colorCode.className = 'color-code';
-                colorCode.textContent = color;
+        # Convert to hex codes, all colors at once
+        hex_colors = color_spaces.rgb_to_hex([rgb for rgb, _ in swatches])
+        swatches = [(color, count) for color, (_, count) in zip(hex_colors, swatches)]
 
-                colorBox.appendChild(colorCode);
-                colorPalette.appendChild(colorBox);
-            });
-        }
+        # The fallback below is not remembered, so it is retried next time
+        remember_colors(key, swatches)
+        return swatches
 
-        function showError(message) {
-            errorMessage.textContent = message;
-            errorMessage.style.display = 'block';
-            loadingSection.style.display = 'none';
-        }
+    except PaletteQueueFull:
+        raise
 
-        function formatDate(dateStr) {
-            if (!dateStr) return '';
-            const date = new Date(dateStr);
-            return date.toLocaleDateString('en-US', { year: 'numeric', month: 'long', day: 'numeric' });
-        }
-    </script>
-</body>
-</html>
-    ''')
+    except Exception as e:
+        print(f"Error extracting colors: {e}")
+        metrics.FALLBACKS.inc(type(e).__name__)
+        # Return some default colors in case of error
+        return list(DEFAULT_SWATCHES)
+
+@routes.app_errorhandler(PaletteQueueFull)
+def palette_queue_full(error):
+    # Shed load instead of queueing requests behind a saturated worker pool
+    return jsonify({"error": "Too many palettes being extracted, try again shortly"}), 503, {'Retry-After': '1'}
+
+@routes.app_errorhandler(RateLimited)
+def rate_limited(error):
+    # Spotify's quota is used up for now, tell the client when to come back instead of queueing
+    retry_after = str(math.ceil(error.retry_after))
+    return jsonify({"error": "Too many requests to Spotify, try again shortly"}), 429, {'Retry-After': retry_after}
+
+@routes.before_app_request
+def start_timing():
+    g.request_start = time.perf_counter()
+    metrics.start_request()
+
+@routes.after_app_request
+def finish_timing(response):
+    if 'request_start' not in g:
+        return response
+    # streamed responses are timed until their headers, the body is still to come
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    header = metrics.finish_request(route, response.status_code, time.perf_counter() - g.request_start)
+    if header is not None:
+        response.headers['Server-Timing'] = header
+    return response
+
+@routes.route('/metrics')
+def prometheus_metrics():
+    """Stage latencies, cache hits, upstream statuses and fallbacks in the Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+#exposes the counters the caches, pool and index already keep, read only when scraped
+@metrics.collector
+def shared_state_metrics():
+    lookups = {
+        'palette': {'hit': palette_cache.hits, 'miss': palette_cache.misses},
+        'search': {'hit': search_cache.hits, 'miss': search_cache.misses},
+        'album': {'hit': album_cache.hits, 'miss': album_cache.misses,
+                  'stale': album_cache.revalidations, 'not_modified': album_cache.not_modified},
+        'app_token': {'hit': app_tokens.hits, 'miss': app_tokens.refreshes + app_tokens.failures},
+    }
+    if artwork.cache is not None:
+        cache = artwork.cache
+        lookups['artwork'] = {'hit': cache.hits, 'miss': cache.misses,
+                              'stale': cache.revalidations, 'not_modified': cache.not_modified}
+    samples = [({'cache': name, 'result': result}, count)
+               for name, results in lookups.items() for result, count in results.items()]
+
+    watches = player_watches.stats()
+    return [
+        ('palette_cache_lookups_total', 'counter',
+         'Cache lookups per cache and result, stale entries are revalidated upstream', samples),
+        ('palette_pool_jobs_total', 'counter', 'Palette extractions queued, or turned away with a 503',
+         [({'result': 'submitted'}, palette_pool.submitted), ({'result': 'rejected'}, palette_pool.rejected)]),
+        ('palette_color_index_size', 'gauge', 'Palettes searchable through /similar', [({}, len(color_index))]),
+        ('palette_live_listeners', 'gauge', 'Open /current-track/stream connections',
+         [({}, watches['subscribers'])]),
+    ]
 
 if __name__ == '__main__':
     print("Setting up the Spotify Album Color Extractor...")
@@ -747,9 +1106,9 @@ if __name__ == '__main__':
     print("   SPOTIFY_CLIENT_SECRET=your_client_secret")
     print("   REDIRECT_URI=http://localhost:5000/callback")
     print("\nInstall the required packages with:")
-    print("pip install flask flask-cors requests Pillow colorthief python-dotenv")
+    print("pip install flask flask-cors requests Pillow colorthief numpy python-dotenv")
     print("\nRun the app with:")
     print("python spotify_color_extractor.py")
     print("\nThen open http://localhost:5000 in your browser")
 
-    app.run(debug=True)
\ No newline at end of file
+    create_app().run(debug=True)
\ No newline at end of file
@@ -0,0 +1,86 @@
+"""The NumPy median cut must pick the same palette as ColorThief's MMCQ.
+
+Both engines quantize the same sampled pixels. Every swatch of the NumPy
+palette has to be within TOLERANCE per channel of the ColorThief swatch at
+the same position, the check benchmarks/bench_quantizer.py runs on demand.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from corpus import load_corpus
+from palette_engines import decode_image, extract_palette
+
+TOLERANCE = 2
+
+COVERS = [pytest.param(data, id=name) for name, data in load_corpus(count=12)]
+
+
+def within_tolerance(reference, palette):
+    return len(reference) == len(palette) and all(
+        abs(a - b) <= TOLERANCE
+        for expected, actual in zip(reference, palette)
+        for a, b in zip(expected, actual))
+
+
+def solid():
+    return Image.new('RGB', (120, 120), (30, 60, 90))
+
+
+def two_colors():
+    image = Image.new('RGB', (120, 120), (250, 10, 10))
+    image.paste((10, 10, 250), (0, 60, 120, 120))
+    return image
+
+
+def mostly_white():
+    # near-white pixels are skipped, only the small square is quantized
+    image = Image.new('RGB', (200, 200), (252, 252, 252))
+    image.paste((90, 140, 40), (80, 80, 110, 110))
+    return image
+
+
+def transparent():
+    image = Image.new('RGBA', (200, 200), (0, 0, 0, 0))
+    image.paste((200, 40, 90, 255), (50, 50, 150, 150))
+    image.paste((20, 120, 230, 255), (80, 0, 120, 200))
+    return image
+
+
+def gradient():
+    ramp = np.arange(256, dtype=np.uint8)
+    red, green = np.meshgrid(ramp, ramp)
+    return Image.fromarray(np.dstack((red, green, 255 - green)), 'RGB')
+
+
+# edge cases the synthetic covers do not reach: a single color, fewer colors
+# than asked for, skipped pixels and an even spread over the whole cube
+SHAPES = [solid, two_colors, mostly_white, transparent, gradient]
+
+
+def palettes(image, original_size, color_count=5, quality=10):
+    return (extract_palette(image, color_count, quality, original_size, 'colorthief'),
+            extract_palette(image, color_count, quality, original_size, 'median-cut'))
+
+
+@pytest.mark.parametrize('data', COVERS)
+@pytest.mark.parametrize('color_count', [2, 5, 10])
+def test_corpus_matches_colorthief(data, color_count):
+    image, original_size = decode_image(data)
+    reference, palette = palettes(image, original_size, color_count)
+    assert within_tolerance(reference, palette), f"colorthief={reference} numpy={palette}"
+
+
+@pytest.mark.parametrize('shape', SHAPES, ids=lambda shape: shape.__name__)
+@pytest.mark.parametrize('quality', [1, 10])
+def test_shapes_match_colorthief(shape, quality):
+    image = shape()
+    reference, palette = palettes(image, image.size, quality=quality)
+    assert within_tolerance(reference, palette), f"colorthief={reference} numpy={palette}"
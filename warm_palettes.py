@@ -0,0 +1,250 @@
+"""Fill the palette store ahead of traffic, e.g. right after a deploy.
+
+    python warm_palettes.py albums.txt --concurrency 16 --engine median-cut
+
+The input has one entry per line: a Spotify album ID, album URI or
+open.spotify.com album link, an artwork URL, or anything else as a search
+query (the top album is warmed, like /limited-search does). Blank lines and
+lines starting with # are skipped. Palettes go through the same cache and
+store as the app, so point PALETTE_STORE at the store the app uses.
+
+Finished entries are appended to a checkpoint file (<input>.done by default),
+so an interrupted run picks up where it stopped when started again. Failed
+entries are not checkpointed and are retried on the next run.
+"""
+import argparse
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlparse
+
+import spotify_color_extractor as extractor
+from http_client import RateLimited
+import palette_engines
+from palette_engines import ENGINES
+from palette_pool import PaletteQueueFull
+from spotify_auth import TokenError
+
+
+def parse_entry(line):
+    """Returns ('album', id), ('image', url) or ('query', text) for an input line"""
+    if line.startswith('spotify:album:'):
+        return 'album', line.rsplit(':', 1)[1]
+
+    url = urlparse(line)
+    if url.scheme in ('http', 'https'):
+        if url.netloc == 'open.spotify.com' and '/album/' in url.path:
+            return 'album', url.path.rstrip('/').rsplit('/', 1)[1]
+        return 'image', line
+
+    if extractor.ALBUM_ID.match(line):
+        return 'album', line
+    return 'query', line
+
+
+def read_entries(path):
+    source = sys.stdin if path == '-' else open(path, encoding='utf-8')
+    with source:
+        for line in source:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
+
+
+def read_checkpoint(path):
+    try:
+        with open(path, encoding='utf-8') as checkpoint:
+            return {line.rstrip('\n') for line in checkpoint}
+    except FileNotFoundError:
+        return set()
+
+
+def work_units(entries, done):
+    """Groups album IDs into multi-album calls, other entries are a unit each"""
+    albums = []
+    for line in entries:
+        if line in done:
+            continue
+        kind, value = parse_entry(line)
+        if kind == 'album':
+            albums.append((line, value))
+            if len(albums) == extractor.ALBUMS_PER_CALL:
+                yield 'albums', albums
+                albums = []
+        else:
+            yield kind, [(line, value)]
+    if albums:
+        yield 'albums', albums
+
+
+def app_headers():
+    return {'Authorization': f"Bearer {extractor.app_tokens.get_token()}"}
+
+
+def warm_image(image_url, engine, retries=5):
+    """Extracts and stores one palette, returns True if a real palette is now stored"""
+    key = (image_url, 5, 10, engine)
+    if extractor.lookup_colors(key) is not None:
+        return True
+
+    for attempt in range(retries):
+        try:
+            extractor.extract_colors(image_url, engine=engine)
+            break
+        except PaletteQueueFull:
+            time.sleep(0.5 * (attempt + 1))
+
+    # extract_colors answers failures with the default colors, which are never stored
+    return extractor.lookup_colors(key) is not None
+
+
+def warm_unit(kind, entries, engine):
+    """Returns [(line, error or None)] for one unit of work"""
+    results = []
+    try:
+        if kind == 'image':
+            return [(line, None if warm_image(url, engine) else "extraction failed")
+                    for line, url in entries]
+
+        if kind == 'query':
+            line, query = entries[0]
+            data, status = extractor.search_albums(query, app_headers())
+            if status == 401:
+                extractor.app_tokens.invalidate()
+            if status != 200:
+                return [(line, f"search failed with {status}")]
+            items = data.get('albums', {}).get('items', [])
+            if len(items) == 0:
+                return [(line, "no albums found")]
+            album_data, status = extractor.complete_album(items[0], app_headers())
+            if album_data is None:
+                return [(line, f"album lookup failed with {status}")]
+            albums = [(line, album_data)]
+        else:
+            found, failed = extractor.fetch_albums([album_id for _, album_id in entries], app_headers())
+            if 401 in failed.values():
+                extractor.app_tokens.invalidate()
+            albums = [(line, found.get(album_id)) for line, album_id in entries]
+            results.extend((line, f"album lookup failed with {failed[album_id]}")
+                           for line, album_id in entries if album_id in failed)
+
+        for line, album_data in albums:
+            if album_data is None:
+                continue
+            if len(album_data.get('images', [])) == 0:
+                results.append((line, "no artwork"))
+                continue
+            _, image_url = extractor.album_summary(album_data)
+            results.append((line, None if warm_image(image_url, engine) else "extraction failed"))
+        return results
+
+    except (TokenError, RateLimited) as e:
+        return [(line, str(e)) for line, _ in entries]
+
+
+class Progress:
+    """Counts finished entries and prints a status line every `every` seconds"""
+
+    def __init__(self, total, skipped, every=5.0):
+        self.total = total
+        self.skipped = skipped
+        self.every = every
+        self.warmed = 0
+        self.failed = 0
+        self.start = time.perf_counter()
+        self._last_report = self.start
+
+    def add(self, error):
+        if error is None:
+            self.warmed += 1
+        else:
+            self.failed += 1
+        if time.perf_counter() - self._last_report >= self.every:
+            self.report()
+
+    def report(self, final=False):
+        now = time.perf_counter()
+        self._last_report = now
+        elapsed = now - self.start
+        finished = self.warmed + self.failed
+        rate = finished / elapsed if elapsed else 0.0
+        remaining = self.total - self.skipped - finished
+        eta = f", eta {remaining / rate:.0f}s" if rate and remaining and not final else ""
+        print(f"{'done' if final else 'progress'}: {finished + self.skipped}/{self.total} "
+              f"({self.warmed} warmed, {self.failed} failed, {self.skipped} already done) "
+              f"{rate:.1f}/s{eta}", flush=True)
+
+
+def warm(path, concurrency=8, engine=None, checkpoint_path=None, restart=False, report_every=5.0):
+    """Warms every entry of `path`, returns the Progress of the run"""
+    extractor.configure()
+    # PALETTE_ENGINE may come from credentials.env, read by configure()
+    engine = engine or palette_engines.DEFAULT_ENGINE
+    checkpoint_path = checkpoint_path or (None if path == '-' else f"{path}.done")
+    done = set() if restart or checkpoint_path is None else read_checkpoint(checkpoint_path)
+
+    entries = list(dict.fromkeys(read_entries(path)))
+    progress = Progress(len(entries), sum(1 for line in entries if line in done), report_every)
+    checkpoint = open(checkpoint_path, 'w' if restart else 'a', encoding='utf-8') if checkpoint_path else None
+
+    def finish(future):
+        for line, error in future.result():
+            progress.add(error)
+            if error is not None:
+                print(f"failed: {line}: {error}", file=sys.stderr)
+            elif checkpoint is not None:
+                checkpoint.write(line + '\n')
+        if checkpoint is not None:
+            checkpoint.flush()
+
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='warm')
+    pending = set()
+    try:
+        # Keep a bounded window in flight so huge inputs do not queue up in memory
+        for kind, unit in work_units(entries, done):
+            pending.add(executor.submit(warm_unit, kind, unit, engine))
+            if len(pending) >= concurrency * 2:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    finish(future)
+        for future in pending:
+            finish(future)
+        pending = set()
+    except KeyboardInterrupt:
+        print("interrupted, finished entries are checkpointed", file=sys.stderr)
+        raise
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        for future in pending:
+            if future.done() and not future.cancelled():
+                finish(future)
+        if checkpoint is not None:
+            checkpoint.close()
+        progress.report(final=True)
+    return progress
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('input', help="file of album IDs, queries or image URLs, '-' for stdin")
+    parser.add_argument('--concurrency', type=int, default=8, help='entries processed at once')
+    parser.add_argument('--engine', choices=sorted(ENGINES), help='defaults to PALETTE_ENGINE')
+    parser.add_argument('--checkpoint', help='file of finished entries, defaults to <input>.done')
+    parser.add_argument('--restart', action='store_true', help='ignore and overwrite the checkpoint')
+    parser.add_argument('--report-every', type=float, default=5.0, help='seconds between progress lines')
+    args = parser.parse_args()
+
+    extractor.configure()
+    try:
+        progress = warm(args.input, args.concurrency, args.engine, args.checkpoint,
+                        args.restart, args.report_every)
+    except KeyboardInterrupt:
+        sys.exit(130)
+    finally:
+        extractor.palette_pool.shutdown()
+        extractor.palette_store.close()
+    sys.exit(1 if progress.failed else 0)
+
+
+if __name__ == '__main__':
+    main()